@@ -1,129 +1,280 @@
 """Maps class."""
+import os
+import json
 import scipy
 import copy
-import nilearn
+import nilearn.image
 import numpy as np
 import nibabel as nib
 import pandas as pd
-from scipy.ndimage import gaussian_filter
 from sklearn.covariance import LedoitWolf
 from scipy.sparse import csr_matrix, hstack
 
-from .globals import mem
+from .blocks import BlockMatrix, block_dot, block_add
+from .cache import fingerprint
+from .smoothing import stamp_smooth, use_stamping, dense_smooth, smooth_block, batch_size, smoothing_operator, \
+    apply_operator, sparsify, negligible
+from .globals import cache
 from .tools import print_percent
 
 import multiprocessing
-from joblib import Parallel, delayed
+from joblib import Parallel, delayed, effective_n_jobs
 
 
-def compute_maps(df, **kwargs):
+def compute_voxel_ids(x, y, z, inv_affine, Ni, Nj, Nk, mask=None):
     '''
-        Given a list of pmids, builds their activity maps (flattened in 1D) on a LIL sparse matrix format.
-        Used for multiprocessing in get_all_maps_associated_to_keyword function.
+        Convert arrays of world coordinates into flattened voxel ids at once.
 
-        pmids : list of pmid
-        Ni, Nj, Nk : size of the 3D box (used to flatten 3D to 1D indices)
+        x, y, z : 1D arrays of world coordinates (one element per peak)
         inv_affine : the affine inverse used to compute voxels coordinates
+        Ni, Nj, Nk : size of the 3D box (used to flatten 3D to 1D indices)
+        mask : dense 3D array with 0 or 1 data or None
 
-        Returns sparse LIL matrix of shape (len(pmids), Ni*Nj*Nk) containing all the maps
+        Returns:
+            ids: 1D array of flattened voxel ids (Fortran ordering)
+            keep: 1D boolean array, True for the peaks falling inside the mask
     '''
-    Ni = kwargs['Ni']
-    Nj = kwargs['Nj']
-    Nk = kwargs['Nk']
-    inv_affine = kwargs['inv_affine']
-    index_dict = kwargs['index_dict']
-    n_maps = kwargs['n_maps']
-    mask = kwargs['mask']
-    verbose = kwargs['verbose']
-    dtype = kwargs['dtype']
+    coords = np.stack([x, y, z, np.ones(len(x))], axis=0)
+    ijk = np.floor(np.dot(inv_affine, coords))[:-1].astype(int)
+    i = np.clip(ijk[0], 0, Ni-1)
+    j = np.clip(ijk[1], 0, Nj-1)
+    k = np.clip(ijk[2], 0, Nk-1)
+
+    if mask is None:
+        keep = np.ones(len(i), dtype=bool)
+    else:
+        keep = mask[i, j, k] == 1
 
-    col_names = kwargs['col_names']
-    groupby_col = col_names['groupby']
-    x_col = col_names['x']
-    y_col = col_names['y']
-    z_col = col_names['z']
-    weight_col = col_names['weight']
+    return Maps.coord_to_id(i, j, k, Ni, Nj, Nk), keep
 
-    maps = scipy.sparse.lil_matrix((n_maps, Ni*Nj*Nk), dtype=dtype)
 
-    n_tot = df.shape[0]
-    for i_row, row in enumerate(zip(df[groupby_col], df[x_col], df[y_col], df[z_col], df[weight_col])):
-        print_percent(i_row, n_tot, string='Loading dataframe {0:.1f}%...', verbose=verbose, prefix='Maps')
+def compute_maps(map_ids, x, y, z, weights, n_maps, Ni, Nj, Nk, inv_affine, mask=None, start=0, stop=None):
+    '''
+        Given the column arrays of a dataframe of peaks, computes the activity maps of the peaks in [start, stop).
+        Used for multiprocessing in build_maps_from_df function: the column arrays are shared
+        with the workers through memory-mapped buffers so that only the slice bounds are sent.
+
+        The inverse affine is applied to every peak in one product, the mask is filtered with one
+        fancy-index lookup and the peaks falling on the same voxel of the same map are summed.
 
-        groupby_id, x, y, z, weight = row
-        map_id = index_dict[groupby_id]
+        map_ids : 1D array of the map id of each peak
+        x, y, z, weights : 1D arrays of the coordinates and weights of each peak
+        Ni, Nj, Nk : size of the 3D box (used to flatten 3D to 1D indices)
+        inv_affine : the affine inverse used to compute voxels coordinates
 
-        i, j, k = np.clip(np.floor(np.dot(inv_affine, [x, y, z, 1]))[:-1].astype(int), [0, 0, 0], [Ni-1, Nj-1, Nk-1])
+        Returns the COO triplets (voxel ids, map ids, weights) of the maps.
+    '''
+    sl = slice(start, stop)
+    ids, keep = compute_voxel_ids(x[sl], y[sl], z[sl], inv_affine, Ni, Nj, Nk, mask=mask)
 
-        if mask is None or mask[i, j, k] == 1:
-            p = Maps.coord_to_id(i, j, k, Ni, Nj, Nk)
-            maps[map_id, p] += weight
+    maps = scipy.sparse.coo_matrix((weights[sl][keep], (ids[keep], map_ids[sl][keep])),
+                                   shape=(Ni*Nj*Nk, n_maps))
+    maps.sum_duplicates()
 
-    return scipy.sparse.csr_matrix(maps)
+    return maps.row, maps.col, maps.data
 
 
-@mem.cache
-def build_maps_from_df(df, col_names, Ni, Nj, Nk, affine, mask=None, verbose=None, dtype=np.float32):
+@cache.cache(ignore=['verbose', 'n_jobs'])
+def build_maps_from_df(df, col_names, Ni, Nj, Nk, affine, mask=None, verbose=None, dtype=np.float32, n_jobs=1):
     '''
-        Given a keyword, finds every related studies and builds their activation maps.
+        Given a dataframe of peaks, builds the activation maps of each group.
+
+        Only the numeric column arrays are extracted from the dataframe. When n_jobs != 1, they are
+        memory-mapped along with the mask and shared with the workers which return compact COO triplets
+        merged in one pass, so that serialization and merge costs scale with the number of peaks.
 
-        reduce : integer, reducing scale factor. Ex : if reduce=2, aggregates voxels every 2 voxels in each direction.
-                Notice that this affects the affine and box size.
+        n_jobs : number of processes (-1 for all cpus).
 
         Returns:
             maps: sparse CSR matrix of shape (n_voxels, n_maps) containing all the related flattenned maps where
                     n_maps is the number of pmids related to the keyword
-                    n_voxels is the number of voxels in the box (may have changed if reduce != 1)
-            Ni_r, Nj_r, Nk_r: new box dimension (changed if reduce != 1)
-            affine_r: new affine (changed if reduce != 1)
+                    n_voxels is the number of voxels in the box
+            map_ids: list of the values of the groupby column, the k-th one being the id of the k-th map
     '''
-
-    df = df.astype({col_names['x']: 'float64',
-                    col_names['y']: 'float64',
-                    col_names['z']: 'float64',
-                    col_names['weight']: 'float64',
-                    })
-
     # Creating map index
-    unique_pmid = df[col_names['groupby']].unique()
+    map_ids, unique_pmid = pd.factorize(df[col_names['groupby']])
     n_maps = len(unique_pmid)
-    index_dict = {k: v for v, k in enumerate(unique_pmid)}
+    n_peaks = df.shape[0]
 
-    # LIL format allows faster incremental construction of sparse matrix
-    maps = scipy.sparse.csr_matrix((n_maps, Ni*Nj*Nk), dtype=dtype)
-
-    # Multiprocessing maps computation
-    n_jobs = multiprocessing.cpu_count()//2
-    splitted_df = np.array_split(df, n_jobs, axis=0)
+    x = df[col_names['x']].values.astype(np.float64)
+    y = df[col_names['y']].values.astype(np.float64)
+    z = df[col_names['z']].values.astype(np.float64)
+    weights = df[col_names['weight']].values.astype(dtype)
 
     kwargs = {
+        'n_maps': n_maps,
         'Ni': Ni,
         'Nj': Nj,
         'Nk': Nk,
         'inv_affine': np.linalg.inv(affine),
-        'index_dict': index_dict,
-        'n_maps': n_maps,
-        'col_names': col_names,
-        'mask': None if mask is None else mask.get_fdata(),
-        'verbose': verbose,
-        'dtype': dtype
     }
+    mask = None if mask is None else mask.get_fdata() == 1
 
-    results = Parallel(n_jobs=n_jobs, backend='multiprocessing')(delayed(compute_maps)(sub_df, **kwargs) for sub_df in splitted_df)
+    n_jobs = effective_n_jobs(n_jobs)
+    bounds = np.linspace(0, n_peaks, n_jobs+1).astype(int)
 
-    for k, m in enumerate(results):
-        if verbose:
-            print_percent(k, n_jobs, string='Merging... {0:.2f}%', prefix='Maps')
-        maps += m
+    print_percent(string=f'Loading dataframe ({n_peaks} peaks)...', verbose=verbose, prefix='Maps')
+    # A boolean MNI mask at 2mm (about 0.9MB) is under 1M and would be pickled to each worker
+    results = Parallel(n_jobs=n_jobs, max_nbytes='100K', mmap_mode='r')(
+        delayed(compute_maps)(map_ids, x, y, z, weights, start=bounds[k], stop=bounds[k+1], mask=mask, **kwargs)
+        for k in range(n_jobs))
 
-    maps = maps.transpose()
+    print_percent(string='Merging...', verbose=verbose, prefix='Maps')
+    rows, cols, data = zip(*results)
+    maps = scipy.sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                   shape=(Ni*Nj*Nk, n_maps), dtype=dtype)
 
-    return maps
+    # Duplicate entries across workers are summed when converting to CSR
+    return maps.tocsr(), list(unique_pmid)
+
+
+@cache.cache(ignore=['verbose'])
+def build_atlas_maps_from_df(df, col_names, Ni, Nj, Nk, affine, label_index, n_labels, mask=None, verbose=None, dtype=np.float64):
+    '''
+        Given a dataframe of peaks, builds the atlas maps of each group without building the voxel maps.
+
+        Each peak is assigned to the label of its voxel through the label index of the atlas. Its weight
+        is divided by the number of voxels of the label so that the atlas maps are the averages over the
+        labels of the voxel maps, as computed by the atlas filter matrix.
+
+        label_index : flattened label index of each voxel, n_labels out of the atlas (see compute_label_index)
+
+        Returns:
+            maps: sparse CSR matrix of shape (n_labels, n_maps) containing the atlas maps
+            map_ids: list of the values of the groupby column, the k-th one being the id of the k-th map
+    '''
+    map_ids, unique_pmid = pd.factorize(df[col_names['groupby']])
+    n_maps = len(unique_pmid)
+
+    x = df[col_names['x']].values.astype(np.float64)
+    y = df[col_names['y']].values.astype(np.float64)
+    z = df[col_names['z']].values.astype(np.float64)
+    weights = df[col_names['weight']].values.astype(dtype)
+    mask = None if mask is None else mask.get_fdata() == 1
+
+    print_percent(string=f'Loading dataframe ({df.shape[0]} peaks) in atlas space...', verbose=verbose, prefix='Maps')
+    ids, keep = compute_voxel_ids(x, y, z, np.linalg.inv(affine), Ni, Nj, Nk, mask=mask)
+    labels = label_index[ids]
+    keep &= labels < n_labels
+    labels = labels[keep]
+
+    sizes = np.bincount(label_index, minlength=n_labels+1)[:n_labels]
+    maps = scipy.sparse.coo_matrix((weights[keep]/sizes[labels], (labels, map_ids[keep])),
+                                   shape=(n_labels, n_maps), dtype=dtype)
+
+    return maps.tocsr(), list(unique_pmid)
+
+
+def iter_coordinate_chunks(path, columns, chunksize=100000):
+    '''
+        Read a csv or parquet coordinate table chunk by chunk.
+
+        path : path to a .csv or .parquet file
+        columns : list of the columns to read (others are skipped)
+        chunksize : number of rows in each chunk
+
+        Yields pandas.DataFrame of at most chunksize rows.
+    '''
+    if path.endswith('.parquet'):
+        try:
+            import pyarrow.parquet as pq
+        except ImportError:
+            raise ImportError('pyarrow is required to read parquet files by chunks.')
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+
+    else:
+        for chunk in pd.read_csv(path, usecols=columns, chunksize=chunksize):
+            yield chunk
+
+
+def build_maps_from_chunks(chunks, col_names, Ni, Nj, Nk, affine, mask=None, verbose=None, dtype=np.float32, map_ids=None):
+    '''
+        Builds the activation maps from an iterable of dataframes without loading the whole table.
+
+        Each chunk is mapped to voxel ids and stored as COO triplets. Pending triplets are merged
+        into the CSR result whenever they outnumber its nonzeros, so that peak memory is bounded by
+        the chunk size and the size of the result, not by the size of the table.
+        Map ids are assigned incrementally, in order of first appearance.
+
+        map_ids : list of already existing map ids. If given, the peaks of these maps
+                  are stored in the first columns and the new maps come after.
+
+        Returns:
+            maps: sparse CSR matrix of shape (n_voxels, n_maps) containing all the flattenned maps
+            map_ids: list of the values of the groupby column, the k-th one being the id of the k-th map
+    '''
+    n_voxels = Ni*Nj*Nk
+    inv_affine = np.linalg.inv(affine)
+    mask = None if mask is None else mask.get_fdata()
 
+    index_dict = dict() if map_ids is None else {k: v for v, k in enumerate(map_ids)}
+    maps = scipy.sparse.csr_matrix((n_voxels, len(index_dict)), dtype=dtype)
+    rows, cols, data = [], [], []
+    n_pending = 0
 
-def build_maps_from_img(img, dtype=np.float32):
+    def merge(maps, rows, cols, data):
+        n_maps = len(index_dict)
+        # Widening a CSR matrix only changes its shape
+        maps = scipy.sparse.csr_matrix((maps.data, maps.indices, maps.indptr), shape=(n_voxels, n_maps))
+
+        if not rows:
+            return maps
+
+        pending = scipy.sparse.coo_matrix((np.concatenate(data), (np.concatenate(rows), np.concatenate(cols))),
+                                          shape=(n_voxels, n_maps), dtype=dtype)
+        return maps + pending.tocsr()
+
+    for k, chunk in enumerate(chunks):
+        print_percent(string=f'Loading chunk {k+1} ({chunk.shape[0]} peaks)...', verbose=verbose, prefix='Maps')
+
+        groupby = chunk[col_names['groupby']]
+        for map_id in groupby.unique():
+            if map_id not in index_dict:
+                index_dict[map_id] = len(index_dict)
+
+        ids, keep = compute_voxel_ids(chunk[col_names['x']].values.astype(np.float64),
+                                      chunk[col_names['y']].values.astype(np.float64),
+                                      chunk[col_names['z']].values.astype(np.float64),
+                                      inv_affine, Ni, Nj, Nk, mask=mask)
+
+        rows.append(ids[keep])
+        cols.append(groupby.map(index_dict).values.astype(int)[keep])
+        data.append(chunk[col_names['weight']].values.astype(dtype)[keep])
+        n_pending += rows[-1].shape[0]
+
+        if n_pending >= maps.nnz:
+            maps = merge(maps, rows, cols, data)
+            rows, cols, data = [], [], []
+            n_pending = 0
+
+    return merge(maps, rows, cols, data), list(index_dict)
+
+
+def build_maps_from_img(img, dtype=np.float32, max_bytes=2**27):
+    '''
+        Builds the maps from a 3D or 4D image without loading it entirely in memory.
+
+        The volumes are read by slabs through nibabel's array proxy and sparsified as they
+        are read, so that peak memory is the size of one slab plus the size of the sparse result.
+        The file is kept open between slabs so that compressed files are read only once.
+
+        max_bytes : maximum size in bytes of the slab of volumes read at once.
+
+        Returns:
+            maps: sparse CSR matrix of shape (n_voxels, n_maps)
+            Ni, Nj, Nk: box dimension
+            affine: affine of the image
+    '''
     img = nilearn.image.load_img(img)
-    n_dims = len(img.get_data().shape)
+
+    # A compressed file is decompressed from its start each time a new handle is opened,
+    # so that the slabs are read forward through one handle kept open
+    if nib.is_proxy(img.dataobj) and img.get_filename() is not None:
+        img = nib.load(img.get_filename(), keep_file_open=True)
+
+    n_dims = len(img.shape)
 
     if n_dims == 4:
         Ni, Nj, Nk, n_maps = img.shape
@@ -135,12 +286,304 @@ def build_maps_from_img(img, dtype=np.float32):
     else:
         raise ValueError('Image not supported. Must be a 3D or 4D image.')
 
-    data = Maps.flatten_array(img.get_data(), _2D=n_maps).astype(dtype)
-    maps = scipy.sparse.csr_matrix(data)
+    # Volumes are read as float64 once scaled
+    slab_size = max(1, int(max_bytes//(8*Ni*Nj*Nk)))
+    blocks = []
+
+    for start in range(0, n_maps, slab_size):
+        if n_dims == 4:
+            data = np.asarray(img.dataobj[..., start:start+slab_size])
+        else:
+            data = np.asarray(img.dataobj)
+
+        data = Maps.flatten_array(data, _2D=data.shape[-1] if n_dims == 4 else 1).astype(dtype)
+        blocks.append(scipy.sparse.csc_matrix(data))
+
+    maps = scipy.sparse.hstack(blocks, format='csr')
 
     return maps, Ni, Nj, Nk, img.affine
 
 
+def build_maps_from_file(path, Ni, Nj, Nk, affine=None, dtype=np.float32):
+    '''
+        Builds the maps of one image file after checking it matches the given box and affine.
+        Used for multithreading in Maps.from_files function.
+
+        Returns sparse CSR matrix of shape (Ni*Nj*Nk, n_maps) where n_maps is 1 for a 3D image.
+    '''
+    maps, Ni_f, Nj_f, Nk_f, affine_f = build_maps_from_img(path, dtype=dtype)
+
+    if (Ni_f, Nj_f, Nk_f) != (Ni, Nj, Nk):
+        raise ValueError(f'Box dimension missmatch. Expected box size is '
+                         f'({Ni}, {Nj}, {Nk}) whereas {path} has size '
+                         f'({Ni_f}, {Nj_f}, {Nk_f}).')
+
+    if affine is not None and not np.allclose(affine, affine_f):
+        raise ValueError(f'Affine missmatch. Expected affine is \n{affine}\n'
+                         f'whereas {path} has affine \n{affine_f}')
+
+    return maps
+
+
+@cache.cache
+def build_smoothing_operator(Ni, Nj, Nk, sigma, truncate=4.0, voxel_ids=None):
+    '''
+        Builds the sparse smoothing operator of the box restricted to the given voxels (see
+        smoothing.smoothing_operator). Cached on disk so that it is shared by every collection
+        with the same box, mask and sigma.
+
+        Returns sparse CSR matrix of shape (Ni*Nj*Nk, Ni*Nj*Nk).
+    '''
+    return smoothing_operator((Ni, Nj, Nk), sigma, truncate=truncate, voxel_ids=voxel_ids)
+
+
+def reduce_box(Ni, Nj, Nk, affine, reduce):
+    '''
+        Compute the box whose voxels aggregate reduce voxels in each direction of the given box.
+
+        Voxel (i, j, k) of the given box falls in voxel (i//reduce, j//reduce, k//reduce) of
+        the reduced one, so that world coordinates are assigned consistently in both boxes.
+
+        Returns:
+            Ni_r, Nj_r, Nk_r: new box dimension
+            affine_r: new affine (None if affine is None)
+    '''
+    Ni_r, Nj_r, Nk_r = (int(np.ceil(N/reduce)) for N in (Ni, Nj, Nk))
+    affine_r = None if affine is None else np.dot(affine, np.diag([reduce, reduce, reduce, 1]))
+
+    return Ni_r, Nj_r, Nk_r, affine_r
+
+
+def build_reduce_matrix(Ni, Nj, Nk, reduce, dtype=np.float64):
+    '''
+        Builds the sparse CSR matrix of shape (n_voxels_r, n_voxels) summing the voxels
+        of the given box into the voxels of the reduced box.
+    '''
+    Ni_r, Nj_r, Nk_r, _ = reduce_box(Ni, Nj, Nk, None, reduce)
+    n_voxels = Ni*Nj*Nk
+
+    i, j, k = np.unravel_index(np.arange(n_voxels), (Ni, Nj, Nk), order='F')
+    rows = np.ravel_multi_index((i//reduce, j//reduce, k//reduce), (Ni_r, Nj_r, Nk_r), order='F')
+
+    return csr_matrix((np.ones(n_voxels, dtype=dtype), (rows, np.arange(n_voxels))),
+                      shape=(Ni_r*Nj_r*Nk_r, n_voxels))
+
+
+def reduce_mask(mask, reduce):
+    '''
+        Reduce a mask Nifti1Image. A voxel of the reduced box is inside the mask if any
+        of the voxels it aggregates is.
+    '''
+    Ni, Nj, Nk = mask.shape
+    Ni_r, Nj_r, Nk_r, affine_r = reduce_box(Ni, Nj, Nk, mask.affine, reduce)
+
+    data = np.asarray(mask.dataobj).reshape(-1, order='F') != 0
+    data_r = build_reduce_matrix(Ni, Nj, Nk, reduce).dot(data) > 0
+
+    return nib.Nifti1Image(data_r.reshape((Ni_r, Nj_r, Nk_r), order='F').astype(np.int8), affine_r)
+
+
+def reduce_labels(data, reduce):
+    '''
+        Reduce a 3D array of labels, keeping the most frequent label among the voxels
+        aggregated in each voxel of the reduced box.
+    '''
+    Ni, Nj, Nk = data.shape
+    Ni_r, Nj_r, Nk_r, _ = reduce_box(Ni, Nj, Nk, None, reduce)
+
+    i, j, k = np.unravel_index(np.arange(Ni*Nj*Nk), (Ni, Nj, Nk), order='F')
+    rows = np.ravel_multi_index((i//reduce, j//reduce, k//reduce), (Ni_r, Nj_r, Nk_r), order='F')
+    labels = data.reshape(-1, order='F')
+
+    # Count each (voxel, label) pair and keep the most frequent label of each voxel
+    pairs, counts = np.unique(np.stack([rows, labels]), axis=1, return_counts=True)
+    order = np.lexsort((counts, pairs[0]))
+    rows, labels = pairs[0][order], pairs[1][order]
+    last = np.append(rows[1:] != rows[:-1], True)
+
+    data_r = np.zeros(Ni_r*Nj_r*Nk_r, dtype=data.dtype)
+    data_r[rows[last].astype(int)] = labels[last]
+
+    return data_r.reshape((Ni_r, Nj_r, Nk_r), order='F')
+
+
+def reduce_atlas(atlas, reduce):
+    '''
+        Reduce an atlas object (see Atlas) by keeping the most frequent label in each voxel.
+        Probabilistic atlases are reduced by averaging the probabilities of the aggregated voxels.
+    '''
+    img = nilearn.image.load_img(atlas['maps'])
+    Ni, Nj, Nk = img.shape[:3]
+    Ni_r, Nj_r, Nk_r, affine_r = reduce_box(Ni, Nj, Nk, img.affine, reduce)
+    atlas_r = dict(atlas)
+
+    if len(img.shape) == 4:
+        reduce_matrix = build_reduce_matrix(Ni, Nj, Nk, reduce)
+        counts = np.asarray(reduce_matrix.sum(axis=1))
+        data = img.get_fdata().reshape((-1, img.shape[3]), order='F')
+        data_r = reduce_matrix.dot(data)/counts
+        atlas_r['maps'] = nib.Nifti1Image(data_r.reshape((Ni_r, Nj_r, Nk_r, -1), order='F'), affine_r)
+    else:
+        atlas_r['maps'] = nib.Nifti1Image(reduce_labels(img.get_fdata(), reduce), affine_r)
+
+    return atlas_r
+
+
+_atlas_filter_matrices = dict()
+
+
+def build_atlas_filter_matrix(atlas_data, n_labels):
+    '''
+        Builds the sparse CSR matrix of shape (n_labels, n_voxels) averaging the voxels of each label.
+
+        atlas_data : 3D array of labels, voxels of the k-th label having value k,
+                     or 4D array of probabilities, the k-th volume being the probability map of the k-th label
+        n_labels : number of labels
+
+        For probabilistic atlases, the voxels are weighted by their probabilities, each row summing to 1.
+        The matrix is built in one pass and cached per atlas fingerprint so that it is shared
+        by every Maps using the same atlas. It must not be modified inplace.
+    '''
+    key = (fingerprint(atlas_data), n_labels)
+
+    if key in _atlas_filter_matrices:
+        return _atlas_filter_matrices[key]
+
+    if atlas_data.ndim == 4:
+        weights = csr_matrix(atlas_data.reshape((-1, n_labels), order='F').transpose(), dtype=np.float64)
+        weights.data[weights.data < 0] = 0
+        weights.eliminate_zeros()
+        sums = np.asarray(weights.sum(axis=1)).reshape(-1)
+        weights.data /= np.repeat(sums, np.diff(weights.indptr))
+
+        _atlas_filter_matrices[key] = weights
+
+    else:
+        labels = atlas_data.reshape(-1, order='F')
+        keep = (labels >= 0) & (labels < n_labels) & (labels == np.floor(labels))
+        rows = labels[keep].astype(int)
+        cols = np.flatnonzero(keep)
+        counts = np.bincount(rows, minlength=n_labels)
+
+        _atlas_filter_matrices[key] = csr_matrix((1/counts[rows], (rows, cols)), shape=(n_labels, labels.size))
+
+    return _atlas_filter_matrices[key]
+
+
+def stack_atlas_filter_matrices(atlases):
+    '''
+        Stack the filter matrices of the given atlases (see build_atlas_filter_matrix) in one sparse
+        CSR matrix of shape (sum of the n_labels, n_voxels), so that the atlas maps of every atlas are
+        computed with one product over the maps. The stacked matrix is cached as the single ones.
+    '''
+    if len(atlases) == 1:
+        return build_atlas_filter_matrix(atlases[0].data, atlases[0].n_labels)
+
+    key = tuple((fingerprint(atlas.data), atlas.n_labels) for atlas in atlases)
+
+    if key not in _atlas_filter_matrices:
+        matrices = [build_atlas_filter_matrix(atlas.data, atlas.n_labels) for atlas in atlases]
+        _atlas_filter_matrices[key] = scipy.sparse.vstack(matrices, format='csr')
+
+    return _atlas_filter_matrices[key]
+
+
+def build_level_matrix(parents, n_parents, sizes):
+    '''
+        Builds the sparse CSR matrix of shape (n_parents, n_labels) aggregating atlas maps into a coarser level.
+
+        parents : 1D array of the parent index of each label, -1 for the labels belonging to no parent
+        n_parents : number of labels of the coarser level
+        sizes : 1D array of the size of each label (number of voxels or sum of probabilities)
+
+        The map of a parent is the average of the maps of its labels weighted by their sizes, that is
+        the average over the voxels of the parent, as computed by the filter matrix of the coarser level.
+    '''
+    keep = (parents >= 0) & (sizes > 0)
+    rows, cols = parents[keep], np.flatnonzero(keep)
+    parent_sizes = np.bincount(rows, weights=sizes[keep], minlength=n_parents)
+
+    return csr_matrix((sizes[keep]/parent_sizes[rows], (rows, cols)), shape=(n_parents, len(parents)))
+
+
+def compute_label_index(atlas_data, n_labels):
+    '''
+        Compute the flattened (Fortran ordering) array of the label index of each voxel.
+
+        Voxels whose value is not a label index in [0, n_labels) are given index n_labels.
+        For probabilistic atlases, each voxel is given its label of maximum probability.
+    '''
+    if atlas_data.ndim == 4:
+        data = atlas_data.reshape((-1, n_labels), order='F')
+        return np.where(data.max(axis=1) > 0, np.argmax(data, axis=1), n_labels).astype(np.intp)
+
+    labels = atlas_data.reshape(-1, order='F')
+    valid = (labels >= 0) & (labels < n_labels) & (labels == np.floor(labels))
+
+    return np.where(valid, labels, n_labels).astype(np.intp)
+
+
+_atlas_registry = dict()
+_atlas_data = dict()
+
+
+def _atlas_key(atlas_maps):
+    if isinstance(atlas_maps, str):
+        path = os.path.abspath(atlas_maps)
+        return (path, os.path.getmtime(path))
+
+    return fingerprint(atlas_maps)
+
+
+def load_atlas_data(atlas_maps):
+    '''
+        Load the labels of an atlas image (or path to it) as a read-only array of the smallest
+        integer type holding them. The array is loaded once per path or content and shared.
+    '''
+    key = _atlas_key(atlas_maps)
+
+    if key not in _atlas_data:
+        data = np.asarray(nilearn.image.load_img(atlas_maps).dataobj)
+
+        if data.size and np.all(data == np.round(data)):
+            dtype = np.result_type(np.min_scalar_type(int(data.min())), np.min_scalar_type(int(data.max())))
+            data = data.astype(dtype)
+
+        data.flags.writeable = False
+        _atlas_data[key] = data
+
+    return _atlas_data[key]
+
+
+def load_atlas(atlas, bg_label='Background'):
+    '''
+        Return the Atlas of the given atlas object (see Atlas), loaded on first request only.
+
+        Atlases are registered process-wide by path (and modification time) or image content,
+        labels and background label. The returned Atlas is shared and must not be modified.
+    '''
+    if atlas is None:
+        return Atlas(None, bg_label=bg_label)
+
+    levels = tuple((tuple(level['labels']), tuple(level['parents'])) for level in atlas.get('levels', []))
+    key = (_atlas_key(atlas['maps']), tuple(atlas['labels']), levels, bg_label)
+
+    if key not in _atlas_registry:
+        _atlas_registry[key] = Atlas(atlas, bg_label=bg_label)
+
+    return _atlas_registry[key]
+
+
+def load_atlases(atlas, bg_label='Background'):
+    '''
+        Return the list of the Atlas of the given atlas object or list of atlas objects (see load_atlas).
+    '''
+    if isinstance(atlas, (list, tuple)) and len(atlas) > 0:
+        return [load_atlas(a, bg_label=bg_label) for a in atlas]
+
+    return [load_atlas(None if isinstance(atlas, (list, tuple)) else atlas, bg_label=bg_label)]
+
+
 class Atlas:
     def __init__(self, atlas=None, bg_label='Background'):
         self.atlas = None
@@ -148,26 +591,76 @@ class Atlas:
         self.data = None
         self.labels = None
         self.n_labels = None
+        self.probabilistic = False
+        self.levels = []
         self.bg_label = bg_label
         self.bg_index = None
         self.labels_without_bg = None
         self.labels_range_without_bg = None
+        self._label_index = None
+        self._level_matrices = dict()
 
         if atlas is None:
             return
 
         self.atlas = atlas
         self.atlas_img = nilearn.image.load_img(atlas['maps'])
-        self.data = self.atlas_img.get_fdata()
+        self.data = load_atlas_data(atlas['maps'])
         self.labels = atlas['labels']
         self.labels_range = list(range(len(self.labels)))
         self.n_labels = len(self.labels)
+        self.probabilistic = self.data.ndim == 4
+
+        if self.probabilistic and self.data.shape[3] != self.n_labels:
+            raise ValueError(f'Probabilistic atlas has {self.data.shape[3]} volumes for {self.n_labels} labels.')
+
+        self.levels = [self._parse_level(level) for level in atlas.get('levels', [])]
 
         self.set_bg_labels(bg_label)
 
     def has_background(self):
         return self.bg_index is not None
 
+    def get_label_index(self):
+        '''
+            Return the label index of each voxel (see compute_label_index), computed once.
+        '''
+        if self._label_index is None:
+            self._label_index = compute_label_index(self.data, self.n_labels)
+            self._label_index.flags.writeable = False
+
+        return self._label_index
+
+    def _parse_level(self, level):
+        labels = list(level['labels'])
+        parents = [-1 if parent is None else labels.index(parent) if isinstance(parent, str) else int(parent)
+                   for parent in level['parents']]
+
+        if len(parents) != self.n_labels:
+            raise ValueError(f'Level has {len(parents)} parents for {self.n_labels} labels.')
+
+        return {'labels': labels, 'parents': np.array(parents, dtype=np.intp)}
+
+    def get_label_sizes(self):
+        '''
+            Return the number of voxels of each label, or the sum of its probabilities for probabilistic atlases.
+        '''
+        if self.probabilistic:
+            return np.clip(self.data.reshape((-1, self.n_labels), order='F'), 0, None).sum(axis=0)
+
+        return np.bincount(self.get_label_index(), minlength=self.n_labels+1)[:self.n_labels]
+
+    def get_level_matrix(self, level):
+        '''
+            Return the matrix aggregating the atlas maps into the given level (see build_level_matrix), computed once.
+        '''
+        if level not in self._level_matrices:
+            parents = self.levels[level]['parents']
+            n_parents = len(self.levels[level]['labels'])
+            self._level_matrices[level] = build_level_matrix(parents, n_parents, self.get_label_sizes())
+
+        return self._level_matrices[level]
+
     def get_labels(self, ignore_bg=False, bg_label=None):
         labels, labels_without_bg = self.labels, self.labels_without_bg
 
@@ -238,7 +731,11 @@ class Maps:
                  weight_col='weight',
                  save_memory=True,
                  verbose=None,
-                 dtype=np.float64
+                 dtype=np.float64,
+                 n_jobs=1,
+                 compact=False,
+                 reduce=1,
+                 space='voxel'
                  ):
         """
         Args:
@@ -249,14 +746,26 @@ class Maps:
             Nk (int): Z size of the bounding box.
             affine (numpy.ndarray): Array with shape (4, 4) storing the affine used to compute brain voxels coordinates from world cooridnates.
             mask (nibabel.Nifti1Image): Nifti1Image with 0 or 1 data.  0: outside the mask, 1: inside.
-            atlas (Object): Object containing a nibabel.Nifti1Image or a path to it in atlas['maps'] and a list of the labels in atlas['labels']
+            atlas (Object): Object containing a nibabel.Nifti1Image or a path to it in atlas['maps'] and a list of the labels in atlas['labels']. The image is either a 3D volume of labels or a 4D probabilistic atlas with one probability volume per label. A list of such objects may be given: the atlas maps of all of them are computed in one product, the first one being used by the atlas-level tools (cov, to_array_atlas...). See get_maps_atlas.
+                An atlas object may also store coarser levels of its parcellation in atlas['levels'], a list of objects containing the labels of the level in level['labels'] and the parent of each label of the atlas in level['parents'] (index or name of the parent label, None if no parent). Maps of the levels are aggregated from the atlas maps. See get_maps_atlas.
             groupby_col (str): Name of the column on which the groupby operation is operated. Or in an equivalent way, the name of the column storing the ids of the maps.
             x_col (str): Name of the column storing the x coordinates.
             y_col (str): Name of the column storing the y coordinates.
             z_col (str): Name of the column storing the z coordinates.
             weight_col (str): Name of the column storing the weights.
+            n_jobs (int): Number of processes used to build the maps from a dataframe (-1 for all cpus).
+            dtype (type): Type of the stored values. Unsigned integer types (e.g. np.uint8) store peak counts compactly: they are promoted to a wider type on overflow, results which are not counts (normalization, averages, smoothing...) being stored in float. Non count values given to these types raise a ValueError.
+            compact (bool): If True and a mask is given, only the voxels inside the mask are stored. Maps are scattered back to the box only when needed.
+            reduce (int): Reducing scale factor. Ex : if reduce=2, aggregates voxels every 2 voxels in each direction. The box, affine, mask and atlas are reduced accordingly. Maps of a dataframe are built directly on the reduced box, peaks being filtered by the reduced mask.
+            space (str): Either 'voxel' or 'atlas'. If 'atlas', the peaks of the dataframe are assigned directly to the labels of the atlas and only the atlas maps of shape (n_labels, n_maps) are stored. Voxel maps are then not available.
 
         """
+        if space not in ['voxel', 'atlas']:
+            raise ValueError(f'Space must be either \'voxel\' or \'atlas\', not {space}.')
+
+        if space == 'atlas' and atlas is None:
+            raise TypeError('Must specify an atlas to build maps in atlas space.')
+
 
         if template is not None and (isinstance(template, nib.Nifti1Image) or isinstance(template, str)):
             template = nilearn.image.load_img(template)
@@ -279,13 +788,30 @@ class Maps:
         if mask is not None and not isinstance(mask, nib.Nifti1Image):
             raise ValueError('Mask must be an instance of nibabel.Nifti1Image')
 
+        # Peaks are assigned directly to the voxels of the reduced box
+        reduce_coordinates = (reduce != 1 and isinstance(df, pd.DataFrame) and affine is not None
+                              and Ni is not None and Nj is not None and Nk is not None)
+
+        if reduce_coordinates:
+            mask = None if mask is None else reduce_mask(mask, reduce)
+            if isinstance(atlas, (list, tuple)):
+                atlas = [reduce_atlas(a, reduce) for a in atlas]
+            elif atlas is not None:
+                atlas = reduce_atlas(atlas, reduce)
+            Ni, Nj, Nk, affine = reduce_box(Ni, Nj, Nk, affine, reduce)
+
         self._save_memory = save_memory
         self._mask = mask
         self._maps = None
-        self._atlas = Atlas(atlas)
+        self._map_ids = None
+        self._compact = compact
+        self._voxel_ids = None
+        self._space = space
+        self._atlases = load_atlases(atlas)
+        self._atlas = self._atlases[0]
         self._maps_dense = None
         self._maps_atlas = None
-        self._atlas_filter_matrix = None
+        self._atlas_filter_matrix = None if space == 'atlas' else self._build_atlas_filter_matrix()
         self._dtype = dtype
         self.verbose = verbose
 
@@ -305,21 +831,33 @@ class Maps:
                 'weight': weight_col
             }
 
-            self._maps = build_maps_from_df(df, col_names, Ni, Nj, Nk, affine, mask, self.verbose, self._dtype)
+            if space == 'atlas':
+                if any(a.probabilistic for a in self._atlases):
+                    raise ValueError('Maps in atlas space can not be built with probabilistic atlases.')
+
+                maps_atlas = []
+                for a in self._atlases:
+                    maps, self._map_ids = build_atlas_maps_from_df(df, col_names, Ni, Nj, Nk, affine,
+                                                                   a.get_label_index(), a.n_labels,
+                                                                   mask, self.verbose, self._build_dtype())
+                    maps_atlas.append(maps)
+                self._maps_atlas = scipy.sparse.vstack(maps_atlas, format='csr')
+            else:
+                self._maps, self._map_ids = build_maps_from_df(df, col_names, Ni, Nj, Nk, affine, mask, self.verbose, self._build_dtype(), n_jobs=n_jobs)
 
         elif isinstance(df, nib.Nifti1Image) or isinstance(df, str) or isinstance(df, list):
-            self._maps, Ni, Nj, Nk, affine = build_maps_from_img(df, dtype=self._dtype)
+            self._maps, Ni, Nj, Nk, affine = build_maps_from_img(df, dtype=self._build_dtype())
 
         elif isinstance(df, np.ndarray) and len(df.shape) == 2:
-            self._maps = scipy.sparse.csr_matrix(df, dtype=self._dtype)
+            self._maps = scipy.sparse.csr_matrix(df)
 
         elif isinstance(df, np.ndarray) and len(df.shape) == 3:
             df = self._flatten_array(df, _2D=1)
-            self._maps = scipy.sparse.csr_matrix(df, dtype=self._dtype)
+            self._maps = scipy.sparse.csr_matrix(df)
 
         elif isinstance(df, np.ndarray) and len(df.shape) == 4:
             df = df.reshape((-1, df.shape[-1]), order='F')
-            self._maps = scipy.sparse.csr_matrix(df, dtype=self._dtype)
+            self._maps = scipy.sparse.csr_matrix(df)
 
         elif isinstance(df, tuple):
             self._maps = scipy.sparse.csr_matrix(df, dtype=self._dtype)
@@ -333,6 +871,12 @@ class Maps:
         elif not isinstance(df, Maps):
             raise TypeError(f'First argument not understood : {type(df)}')
 
+        if space == 'atlas' and self._maps is not None:
+            raise ValueError('Maps in atlas space can only be built from a dataframe.')
+
+        if self._maps is not None:
+            self._maps = self._cast(self._maps)
+
         if Ni is None or Nj is None or Nk is None:
             raise TypeError('Must either specify Ni, Nj, Nk or template.')
 
@@ -350,7 +894,7 @@ class Maps:
         if self._atlas_dimensions_missmatch():
             raise ValueError(f'Atlas dimensions missmatch. Given box size is '
                              f'({self.Ni}, {self.Nj}, {self.Nk}) whereas '
-                             f'atlas size is {self._atlas.data.shape}. '
+                             f'atlas sizes are {[a.data.shape[:3] for a in self._atlases]}. '
                              f'Consider resampling input data or atlas.')
 
         if self._box_dimensions_missmatch():
@@ -362,65 +906,88 @@ class Maps:
         if self._has_mask():
             self.apply_mask(mask)
 
-        self._refresh_atlas_maps()
+        if reduce != 1 and not reduce_coordinates:
+            self.reduce(reduce, inplace=True)
+            return
 
-        if not save_memory:
-            self._set_dense_maps()
+        self._invalidate_maps()
 
     # _____________PROPERTIES_____________ #
     @property
     def save_memory(self):
-        return self._save_memory
+        # Dense maps of out-of-core maps are never held in memory
+        return self._save_memory or self._is_out_of_core()
 
     @save_memory.setter
     def save_memory(self, save_memory):
         self._save_memory = save_memory
 
         if save_memory:
-            if hasattr(self, '_maps_dense'):
-                del self._maps_dense
+            self._maps_dense = None
         else:
-            self._set_dense_maps()
+            self._dense_maps_dirty = True
 
     @property
     def maps(self):
-        return self._maps
+        return self._expand(self._maps)
 
     @maps.setter
     def maps(self, maps):
-        if not scipy.sparse.issparse(maps) or maps.getformat() != 'csr':
+        if not isinstance(maps, BlockMatrix) and (not scipy.sparse.issparse(maps) or maps.getformat() != 'csr'):
             maps = scipy.sparse.csr_matrix(maps)
 
-        self._maps = maps.astype(self._dtype)
-        self._refresh_atlas_maps()
-
-        if hasattr(self, '_save_memory') and not self._save_memory:
-            self._set_dense_maps()
+        self._maps = self._cast(self._compress(maps))
+        self._invalidate_maps()
 
     def _set_maps(self, maps, refresh_atlas_maps=True, refresh_dense_maps=True):
-        self._maps = maps.astype(self._dtype)
+        self._maps = self._cast(self._compress(maps))
+        self._invalidate_maps(atlas=refresh_atlas_maps, dense=refresh_dense_maps)
 
-        if refresh_atlas_maps:
+    # Atlas and dense maps are derived from the maps on first access after a change
+    @property
+    def _maps_atlas(self):
+        if self._atlas_maps_dirty:
             self._refresh_atlas_maps()
+        return self._atlas_maps
 
-        if refresh_dense_maps and hasattr(self, '_save_memory') and not self._save_memory:
+    @_maps_atlas.setter
+    def _maps_atlas(self, maps_atlas):
+        self._atlas_maps = maps_atlas
+        self._atlas_maps_dirty = False
+
+    @property
+    def _maps_dense(self):
+        if self._dense_maps_dirty:
             self._set_dense_maps()
+        return self._dense_maps
+
+    @_maps_dense.setter
+    def _maps_dense(self, maps_dense):
+        self._dense_maps = maps_dense
+        self._dense_maps_dirty = False
 
     @property
     def n_voxels(self):  # Deprecated
-        return 0 if self._maps is None else self._maps.shape[0]
+        return self.n_v
 
     @property
     def n_v(self):
-        return 0 if self._maps is None else self._maps.shape[0]
+        if self._maps is None:
+            return 0
+        return self.prod_N if self._is_compact(self._maps) else self._maps.shape[0]
 
     @property
     def n_maps(self):  # Deprecated
-        return 0 if self._maps is None else self._maps.shape[1]
+        return self.n_m
 
     @property
     def n_m(self):
-        return 0 if self._maps is None else self._maps.shape[1]
+        maps = self._maps_atlas if self._space == 'atlas' else self._maps
+        return 0 if maps is None else maps.shape[1]
+
+    @property
+    def map_ids(self):
+        return self._map_ids
 
     @property
     def Ni(self):
@@ -458,7 +1025,17 @@ class Maps:
 
         i, j, k = self.xyz_to_ijk(x, y, z)
         p = self._coord_to_id(i, j, k)
-        self.maps[p, id] = val
+
+        if self._is_compact(self._maps):
+            row = np.searchsorted(self._voxel_ids, p)
+            if row < len(self._voxel_ids) and self._voxel_ids[row] == p:
+                p = row
+            else:  # Voxel outside the mask: back to the box storage
+                self._maps = self.maps
+                self._voxel_ids = None
+
+        self._maps[p, id] = val
+        self._invalidate_maps()
 
     def xyz_to_ijk(self, x, y, z):
         if self.affine is None:
@@ -524,6 +1101,98 @@ class Maps:
             random_state=random_state
         )
 
+    @classmethod
+    def from_coordinate_chunks(cls, chunks, groupby_col=None, x_col='x',
+                               y_col='y', z_col='z', weight_col='weight',
+                               chunksize=100000, **kwargs):
+        """
+        Create maps from a coordinate table too large to fit in memory.
+
+        The table is consumed chunk by chunk so that peak memory is bounded
+        by the chunk size and the size of the maps, not by the table size.
+        See Maps.__init__ doc for the column names and valid kwargs.
+
+        Args:
+            chunks: Iterable of pandas.DataFrame or path to a .csv or
+                .parquet file (reading parquet files requires pyarrow).
+            chunksize (int, Optional): Number of rows read at once when a
+                path is given.
+
+        Returns:
+            (Maps) Instance of Maps object. The map_ids attribute stores the
+                groupby values in order of first appearance.
+
+        """
+        if groupby_col is None:
+            raise TypeError('Must specify column name to group by maps.')
+
+        maps = cls.empty(**kwargs)
+
+        if maps.affine is None:
+            raise TypeError('Must specify affine to initialize with '
+                            'coordinates.')
+
+        col_names = {
+            'groupby': groupby_col,
+            'x': x_col,
+            'y': y_col,
+            'z': z_col,
+            'weight': weight_col
+        }
+
+        if isinstance(chunks, str):
+            chunks = iter_coordinate_chunks(chunks, list(col_names.values()),
+                                            chunksize=chunksize)
+
+        maps.maps, maps._map_ids = build_maps_from_chunks(
+            chunks, col_names, maps.Ni, maps.Nj, maps.Nk, maps.affine,
+            maps._mask, maps.verbose, maps._build_dtype())
+
+        return maps
+
+    @classmethod
+    def from_files(cls, paths, n_jobs=1, backend='threading', **kwargs):
+        """
+        Create maps from a sequence of image files loaded concurrently.
+
+        Files are decompressed and sparsified in a pool of workers and the
+        maps are stacked in the order of the given paths without building
+        a dense 4D array. See Maps.__init__ doc for valid kwargs.
+
+        Args:
+            paths (sequence): Paths to 3D or 4D images. If no template nor
+                box size is given, the first image serves as template.
+            n_jobs (int, Optional): Number of workers (-1 for all cpus).
+            backend (str, Optional): Joblib backend, 'threading' or 'loky'.
+
+        Returns:
+            (Maps) Instance of Maps object.
+
+        Raises:
+            ValueError: If empty sequence or if an image does not match the
+                template box size or affine.
+
+        """
+        if not paths:
+            raise ValueError('Empty sequence given.')
+
+        if kwargs.get('template') is None and kwargs.get('Ni') is None:
+            kwargs['template'] = paths[0]
+
+        maps = cls.empty(**kwargs)
+
+        blocks = Parallel(n_jobs=n_jobs, backend=backend)(
+            delayed(build_maps_from_file)(path, maps.Ni, maps.Nj, maps.Nk,
+                                          maps.affine, maps._build_dtype())
+            for path in paths)
+
+        maps.maps = hstack(blocks, format='csr')
+
+        if maps._has_mask():
+            maps.apply_mask(maps._mask)
+
+        return maps
+
     @classmethod
     def copy_header(cls, other):
         """
@@ -566,6 +1235,82 @@ class Maps:
 
         return res
 
+    @classmethod
+    def load(cls, path, mmap=True):
+        """
+        Load maps saved with Maps.save.
+
+        Maps saved by blocks are loaded out-of-core: their blocks stay on
+        disk and statistics, smoothing, normalization and conversion to
+        images are computed in streaming passes over the blocks.
+
+        Args:
+            path (str): Directory the maps were saved in.
+            mmap (bool, Optional): If True, the arrays are memory-mapped so
+                that only the pages accessed are read from disk. Else they
+                are loaded in memory.
+
+        Returns:
+            (Maps) Instance of Maps object.
+
+        """
+        # Copy-on-write: modifications stay in memory and never reach the files
+        mmap_mode = 'c' if mmap else None
+
+        def load_array(name):
+            return np.load(os.path.join(path, f'{name}.npy'), mmap_mode=mmap_mode, allow_pickle=False)
+
+        def load_sparse(name, shape):
+            return csr_matrix((load_array(f'{name}_data'), load_array(f'{name}_indices'),
+                               load_array(f'{name}_indptr')), shape=shape, copy=False)
+
+        with open(os.path.join(path, 'header.json'), 'r') as file:
+            header = json.load(file)
+
+        affine = None if header['affine'] is None else np.array(header['affine'])
+        mask = None
+        if header['has_mask']:
+            mask = nib.Nifti1Image(np.load(os.path.join(path, 'mask.npy')), affine)
+
+        atlas = None
+        if header['has_atlas']:
+            labels = [header['atlas_labels']] + header.get('atlases', [])
+            levels = header.get('atlas_levels') or [[] for _ in labels]
+            atlas = [{
+                'maps': nib.Nifti1Image(np.load(os.path.join(path, 'atlas.npy' if k == 0 else f'atlas_{k}.npy')), affine),
+                'labels': labels[k],
+                'levels': levels[k]
+            } for k in range(len(labels))]
+
+        maps = cls(Ni=header['Ni'], Nj=header['Nj'], Nk=header['Nk'], affine=affine,
+                   dtype=np.dtype(header['dtype']).type, save_memory=header['save_memory'])
+        maps._mask = mask
+        maps._atlases = load_atlases(atlas, bg_label=header['atlas_bg_label'])
+        maps._atlas = maps._atlases[0]
+        maps._space = header.get('space', 'voxel')
+
+        if header.get('compact', False):
+            maps._compact = True
+            maps._voxel_ids = np.flatnonzero(maps._flatten_array(np.asarray(mask.dataobj)))
+
+        if header.get('blocks', False):
+            maps._maps = BlockMatrix(os.path.join(path, 'maps'))
+
+        elif header['shape'] is not None:
+            maps._maps = load_sparse('maps', tuple(header['shape']))
+
+        if header['map_ids'] is not None:
+            maps._map_ids = np.load(os.path.join(path, 'map_ids.npy'), allow_pickle=True).tolist()
+
+        if header['has_atlas']:
+            maps._atlas_filter_matrix = maps._build_atlas_filter_matrix()
+            if header['atlas_shape'] is not None:
+                maps._maps_atlas = load_sparse('atlas_maps', tuple(header['atlas_shape']))
+
+        maps._invalidate_maps(atlas=header['has_atlas'] and header['atlas_shape'] is None)
+
+        return maps
+
     # _____________PRIVATE_TOOLS_____________ #
     def _copy_header(self, other):
         self._Ni = other._Ni
@@ -575,14 +1320,19 @@ class Maps:
         self._mask = other._mask
         self._save_memory = other._save_memory
         self._atlas = other._atlas
+        self._atlases = other._atlases
+        self._compact = other._compact
+        self._voxel_ids = other._voxel_ids
+        self._space = other._space
 
         return self
 
     def __str__(self):
+        maps = self._maps_atlas if self._space == 'atlas' else self._maps
         return (
             f'\nMaps object containing {self.n_m} maps.\n'
             f'____________Header_____________\n'
-            f'N Nonzero : {self.maps.count_nonzero()}\n'
+            f'N Nonzero : {0 if maps is None else maps.count_nonzero()}\n'
             f'N voxels : {self.n_v}\n'
             f'N maps : {self.n_m}\n'
             f'Box size : ({self.Ni}, {self.Nj}, {self.Nk})\n'
@@ -626,23 +1376,41 @@ class Maps:
         if not self._has_atlas():
             return
 
-        atlas_data = self._flatten_array(self._atlas.data)
-        filter_matrix = scipy.sparse.lil_matrix((self._atlas.n_labels, self.prod_N))
+        return stack_atlas_filter_matrices(self._atlases)
+
+    def _atlas_rows(self, atlas_id):
+        '''
+            Slice of the rows of the given atlas in the stacked atlas maps.
+        '''
+        bounds = np.cumsum([0]+[a.n_labels for a in self._atlases])
+        return slice(bounds[atlas_id], bounds[atlas_id+1])
 
-        for k in range(self._atlas.n_labels):
-            row = atlas_data == k
-            filter_matrix[k, row] = 1/np.sum(row)
+    def _invalidate_maps(self, atlas=True, dense=True):
+        '''
+            Mark the atlas and dense maps as outdated so that they are
+            recomputed on their next access.
+        '''
+        if atlas:
+            self._atlas_maps_dirty = True
 
-        return scipy.sparse.csr_matrix(filter_matrix)
+        if dense:
+            self._dense_maps_dirty = True
 
     def _refresh_atlas_maps(self):
+        self._atlas_maps_dirty = False
+
         if not self._has_atlas() or self._maps is None:
             return
 
         if self._atlas_filter_matrix is None:
             self._atlas_filter_matrix = self._build_atlas_filter_matrix()
 
-        self._maps_atlas = self._atlas_filter_matrix.dot(self.maps)
+        if self._is_out_of_core():
+            self._maps_atlas = self._maps.hstack(lambda block, cols: self._atlas_filter_matrix.dot(block))
+        elif self._is_compact(self._maps):
+            self._maps_atlas = self._atlas_filter_matrix[:, self._voxel_ids].dot(self._maps)
+        else:
+            self._maps_atlas = self._atlas_filter_matrix.dot(self._maps)
 
     def _has_atlas(self):
         return self._atlas is not None and self._atlas.atlas is not None
@@ -650,14 +1418,127 @@ class Maps:
     def _has_mask(self):
         return self._mask is not None and isinstance(self._mask, nib.Nifti1Image)
 
+    def _is_out_of_core(self):
+        return isinstance(self._maps, BlockMatrix)
+
+    def _is_compact(self, maps):
+        if self._voxel_ids is None or maps is None:
+            return False
+        return maps.shape[0] == len(self._voxel_ids) != self.prod_N
+
+    def _compress(self, maps):
+        '''
+            Restrict maps of shape (n_voxels, n_maps) to the voxels of the mask.
+
+            If the maps have values outside the mask, they are kept in the box
+            and the compact storage is dropped.
+        '''
+        if self._voxel_ids is None or not scipy.sparse.issparse(maps) or maps.shape[0] != self.prod_N:
+            return maps
+
+        maps = scipy.sparse.csr_matrix(maps)
+
+        if np.diff(maps.indptr)[self._voxel_ids].sum() < maps.nnz:
+            self._voxel_ids = None
+            return maps
+
+        return maps[self._voxel_ids]
+
+    def _expand(self, maps):
+        '''
+            Scatter maps stored on the voxels of the mask back to the box.
+
+            Sparse maps share their data and indices with the given ones.
+        '''
+        if not self._is_compact(maps) or isinstance(maps, BlockMatrix):
+            return maps
+
+        if isinstance(maps, np.ndarray):
+            array = np.zeros((self.prod_N,)+maps.shape[1:], dtype=maps.dtype)
+            array[self._voxel_ids] = maps
+            return array
+
+        maps = scipy.sparse.csr_matrix(maps)
+        counts = np.zeros(self.prod_N, dtype=maps.indptr.dtype)
+        counts[self._voxel_ids] = np.diff(maps.indptr)
+        indptr = np.concatenate([[0], np.cumsum(counts)]).astype(maps.indptr.dtype)
+
+        return csr_matrix((maps.data, maps.indices, indptr), shape=(self.prod_N, maps.shape[1]))
+
+    def _build_dtype(self):
+        # Counts are accumulated in float and cast afterwards to not overflow
+        return np.float64 if np.dtype(self._dtype).kind == 'u' else self._dtype
+
+    def _set_float_dtype(self):
+        # Results which are not counts (averages, normalized or smoothed maps) are stored in float
+        if np.dtype(self._dtype).kind in 'ui':
+            self._dtype = np.float64
+
+    @staticmethod
+    def _widen(maps):
+        '''
+            Convert integer maps to float before arithmetic which could overflow.
+        '''
+        if np.dtype(maps.dtype).kind in 'ui':
+            return maps.astype(np.float64)
+        return maps
+
+    def _cast(self, maps):
+        '''
+            Cast maps to the dtype of the instance.
+
+            If it is an unsigned integer type, the dtype is promoted to a wider one when
+            a count overflows. Operations giving non count values set a float dtype
+            beforehand (see _set_float_dtype).
+
+            Raises:
+                ValueError: If maps of unsigned integer type are given non count values.
+        '''
+        dtype = np.dtype(self._dtype)
+
+        if dtype.kind != 'u' or not scipy.sparse.issparse(maps):
+            return maps.astype(self._dtype)
+
+        data = maps.data
+        if data.size == 0:
+            return maps.astype(self._dtype)
+
+        if data.min() < 0 or np.any(data != np.floor(data)):
+            raise ValueError(f'Maps of type {dtype} only hold counts. Use a float dtype for non count values.')
+
+        self._dtype = np.promote_types(dtype, np.min_scalar_type(int(data.max()))).type
+
+        return maps.astype(self._dtype)
+
+    def _map_to_array(self, maps):
+        if not self._is_compact(maps):
+            return self.map_to_array(maps, self._Ni, self._Nj, self._Nk)
+
+        array = np.zeros((self.prod_N, maps.shape[1]), dtype=maps.dtype)
+        array[self._voxel_ids] = maps.toarray()
+
+        return self._unflatten_array(array, _4D=maps.shape[1])
+
+    def _check_voxel_space(self):
+        if self._space == 'atlas':
+            raise ValueError('No voxel maps for maps in atlas space.')
+
     def _get_maps(self, map_id=None, atlas=False, dense=False):
 
         if atlas and dense:
             raise ValueError('No dense maps for atlas.')
 
+        if not atlas:
+            self._check_voxel_space()
+
+        if atlas and len(self._atlases) > 1:
+            maps_atlas = self._maps_atlas[self._atlas_rows(0)]
+        elif atlas:
+            maps_atlas = self._maps_atlas
+
         if map_id is None:
             if atlas:
-                return self._maps_atlas
+                return maps_atlas
 
             elif dense:
                 return self._maps_dense
@@ -667,7 +1548,7 @@ class Maps:
 
         else:
             if atlas:
-                return self._maps_atlas[:, map_id]
+                return maps_atlas[:, map_id]
 
             elif dense:
                 return self._maps_dense[:, :, :, map_id]
@@ -676,10 +1557,10 @@ class Maps:
                 return self._maps[:, map_id]
 
     def _set_dense_maps(self):
-        if self._maps is None:
+        if self._maps is None or self.save_memory:
             self._maps_dense = None
         else:
-            self._maps_dense = Maps.unflatten_array(self._maps.toarray(), self._Ni, self._Nj, self._Nk, _4D=self.n_maps)
+            self._maps_dense = self._map_to_array(self._maps)
 
     def _box_dimensions_missmatch(self):
         Ni, Nj, Nk = self._Ni, self._Nj, self._Nk
@@ -705,10 +1586,7 @@ class Maps:
         if not self._has_atlas():
             return False
 
-        if (self._Ni, self._Nj, self._Nk) == self._atlas.data.shape:
-            return False
-
-        return True
+        return any((self._Ni, self._Nj, self._Nk) != a.data.shape[:3] for a in self._atlases)
 
     def _should_verbose(self, verbose):
         if verbose is None:
@@ -721,7 +1599,17 @@ class Maps:
     # _____________OPERATORS_____________ #
 
     def __iadd__(self, val):
-        self.maps += val.maps
+        if np.dtype(val._dtype).kind not in 'ui':
+            self._set_float_dtype()
+
+        if self._is_out_of_core() or val._is_out_of_core():
+            # The sum is computed in a pass over the blocks of the out-of-core operand
+            blocks, other = (self._maps, val) if self._is_out_of_core() else (val._maps, self)
+            other = other._maps if other._is_out_of_core() else other.maps
+            self.maps = blocks.map_blocks(lambda block, cols: block_add(self._widen(block),
+                                                                        scipy.sparse.csr_matrix(other[:, cols])))
+        else:
+            self.maps = self._widen(self.maps) + val.maps
         return self
 
     def __add__(self, other):
@@ -730,7 +1618,13 @@ class Maps:
         return result
 
     def __imul__(self, val):
-        self.maps *= val
+        if not np.issubdtype(np.asarray(val).dtype, np.integer):
+            self._set_float_dtype()
+
+        if self._is_out_of_core():
+            self.maps = self._maps.map_blocks(lambda block, cols: self._widen(block) * val)
+        else:
+            self.maps = self._widen(self.maps) * val
         return self
 
     def __mul__(self, val):
@@ -796,7 +1690,7 @@ class Maps:
         if map_id is not None:
             maps = self._maps[:, map_id]
 
-        return self.map_to_array(maps, self._Ni, self._Nj, self._Nk)
+        return self._map_to_array(maps)
 
     def to_img(self, map_id=None, sequence=False, verbose=None):
         '''
@@ -828,21 +1722,41 @@ class Maps:
                 n_tot = len(maps_range)
                 for i, k in enumerate(maps_range):
                     print_percent(i, n_tot, string='Converting {1} out of {2}... {0:.2f}%', verbose=verbose, rate=0, prefix='Maps')
-                    res.append(self.map_to_img(maps[:, k], self._Ni, self._Nj, self._Nk, self._affine))
+                    res.append(self.array_to_img(self._map_to_array(maps[:, k]), self._affine))
                 return res
 
             return np.concatenate(Parallel(n_jobs=n_jobs, backend='threading')(delayed(to_img_pool)(sub_array) for sub_array in splitted_range))
 
-        return self.map_to_img(maps, self._Ni, self._Nj, self._Nk, self._affine)
+        return self.array_to_img(self._map_to_array(maps), self._affine)
 
     @staticmethod
     def _one_map_to_array_atlas(map, Ni, Nj, Nk, atlas_data, label_range):
-        array = np.zeros((Ni, Nj, Nk))
+        label_index = compute_label_index(atlas_data, map.shape[0])
+        return Maps._maps_to_array_atlas(map, Ni, Nj, Nk, label_index, label_range)[:, :, :, 0]
+
+    @staticmethod
+    def _maps_to_array_atlas(maps, Ni, Nj, Nk, label_index, label_range):
+        '''
+            Back-project atlas maps of shape (n_labels, n_maps) on the voxels of their labels.
+
+            The values of the labels in label_range are gathered in one pass through a lookup
+            table indexed by the label index of each voxel (see compute_label_index).
+
+            Returns a 4D array of shape (Ni, Nj, Nk, n_maps).
+        '''
+        n_labels, n_maps = maps.shape
+        label_range = list(label_range)
+
+        # Last column stays zero for the voxels out of the labels
+        lut = np.zeros((n_maps, n_labels+1))
+        values = maps[label_range]
+        lut[:, label_range] = (values.toarray() if scipy.sparse.issparse(values) else values).T
 
-        for k in label_range:
-            array[atlas_data == k] = map[k, 0]
+        # Gathering each map in a contiguous row of the transposed output
+        array = np.empty((n_maps, label_index.shape[0]))
+        np.take(lut, label_index, axis=1, out=array, mode='clip')
 
-        return array
+        return array.T.reshape((Ni, Nj, Nk, n_maps), order='F')
 
     def to_array_atlas(self, map_id=None, ignore_bg=True, bg_label=None):
         '''
@@ -880,16 +1794,12 @@ class Maps:
         if map_id is None and self.n_maps == 1:
             map_id = 0
 
-        if map_id is None:
-            array = np.zeros((self._Ni, self._Nj, self._Nk, self.n_maps))
-
-            for k in range(self.n_maps):
-                array[:, :, :, k] = self._one_map_to_array_atlas(self._maps_atlas[:, k], self._Ni, self._Nj, self._Nk, self._atlas.data, label_range)
-        else:
-            array = np.zeros((self._Ni, self._Nj, self._Nk))
-            array[:, :, :] = self._one_map_to_array_atlas(self._maps_atlas[:, map_id], self._Ni, self._Nj, self._Nk, self._atlas.data, label_range)
+        maps = self._get_maps(atlas=True)
+        if map_id is not None:
+            maps = maps[:, [map_id]]
+        array = self._maps_to_array_atlas(maps, self._Ni, self._Nj, self._Nk, self._atlas.get_label_index(), label_range)
 
-        return array
+        return array if map_id is None else array[:, :, :, 0]
 
     def to_img_atlas(self, map_id=None, ignore_bg=False):
         '''
@@ -908,37 +1818,64 @@ class Maps:
         '''
         return self.array_to_img(self.to_array_atlas(map_id=map_id, ignore_bg=ignore_bg), self._affine)
 
-    def _to_map_atlas(self, data):
-        if isinstance(data, np.ndarray):
-            data = scipy.sparse.csr_matrix(self.flatten_array(data, _2D=1))
+    @staticmethod
+    def _argmax_rows(maps):
+        '''
+            Compute the maximum positive value of each row of a sparse matrix and the first
+            column reaching it, without densifying the matrix.
+
+            Returns:
+                values: 1D array of the maximums, 0 for the rows without positive values
+                cols: 1D array of the columns of the maximums, -1 for the rows without positive values
+        '''
+        maps = scipy.sparse.csr_matrix(maps)
+        maps.sum_duplicates()
+
+        rows = np.repeat(np.arange(maps.shape[0]), np.diff(maps.indptr))
+        positive = maps.data > 0
+        rows, cols, data = rows[positive], maps.indices[positive], maps.data[positive]
+
+        # Sort by row, decreasing value and increasing column: first entry of each row is kept
+        order = np.lexsort((cols, -data, rows))
+        rows, cols, data = rows[order], cols[order], data[order]
+        first = np.append(True, rows[1:] != rows[:-1]) if rows.size else np.zeros(0, dtype=bool)
 
-        return self._atlas_filter_matrix.dot(data)
+        values = np.zeros(maps.shape[0], dtype=np.float64)
+        argmax = np.full(maps.shape[0], -1, dtype=np.int64)
+        values[rows[first]] = data[first]
+        argmax[rows[first]] = cols[first]
+
+        return values, argmax
 
     def to_atlas(self, bg_label=None):
         '''
             Converts the maps into an atlas by creating a label for each different values.
 
+            If several maps are stored, the label of each voxel is one plus the id of the map
+            of maximum positive value (0 if none), computed from the sparse rows of the maps.
+
             Returns:
-                (nibabel.Nifti1Image) Nifti1Image containing the atlas
+                (nibabel.Nifti1Image) Nifti1Image containing the atlas as a compact integer volume
                 () Labels of the regions
         '''
+        if self.n_maps == 1:
+            array = self.to_array(0)
+            if array.size and array.min() >= 0 and np.all(array == np.floor(array)):
+                array = array.astype(np.min_scalar_type(int(array.max())))
 
-        array = self.to_array()
-
-        # print(np.histogram(array))
-        # print(np.unique(array))
-        # uniques = np.unique(array)
-        # n_tot = len(uniques)
-        if len(array.shape) == 4:
-            array = np.concatenate((np.zeros(array.shape[:-1]+(1,)), array), axis=3)
-            array = np.argmax(array, axis=3)
-        # array_atlas = np.zeros(array.shape[:-1])
+        else:
+            best = np.zeros(self.n_v)
+            labels = np.zeros(self.n_v, dtype=np.min_scalar_type(self.n_maps))
+            blocks = self._maps.blocks() if self._is_out_of_core() else [(self.maps, slice(0, self.n_maps))]
 
-        # # print(np.histogram(np.argmax(array, axis=3)))
+            for block, cols in blocks:
+                values, argmax = self._argmax_rows(block)
+                # Earlier maps win ties
+                better = values > best
+                best[better] = values[better]
+                labels[better] = argmax[better] + cols.start + 1
 
-        # for k in range(self.n_maps):
-        #     print_percent(k, self.n_maps, string='Converting to atlas label {1} out of {2} : {0:.2f}%...', rate=0, verbose=verbose)
-        #     array_atlas[array[:, :, :, k] > 0] = k+1
+            array = self._unflatten_array(labels)
 
         if self.n_maps == 1:  # Atlas stored on one map
             # n_labels = len(np.unique(self.to_array(0)))
@@ -967,6 +1904,80 @@ class Maps:
         return {'maps': nib.Nifti1Image(array, self._affine), 'labels': L}
 
     # _____________PUBLIC_TOOLS_____________ #
+    def save(self, path, block_size=None):
+        '''
+            Save the maps in a directory of raw arrays which can be memory-mapped by Maps.load.
+
+            The CSR arrays of the maps and atlas maps, the mask, the atlas labels
+            and the map ids are stored in .npy files and the header in header.json.
+
+            Args:
+                path (str): Directory to save the maps in. Created if needed.
+                block_size (int, optional): If given, the maps are stored in
+                    npz shards of block_size maps and are loaded out-of-core
+                    by Maps.load. Out-of-core maps keep their blocks if None.
+        '''
+        os.makedirs(path, exist_ok=True)
+
+        def save_array(name, array):
+            np.save(os.path.join(path, f'{name}.npy'), array)
+
+        def save_sparse(name, matrix):
+            matrix = scipy.sparse.csr_matrix(matrix)
+            save_array(f'{name}_data', matrix.data)
+            save_array(f'{name}_indices', matrix.indices)
+            save_array(f'{name}_indptr', matrix.indptr)
+
+        header = {
+            'format_version': 1,
+            'Ni': int(self._Ni),
+            'Nj': int(self._Nj),
+            'Nk': int(self._Nk),
+            'affine': None if self._affine is None else np.asarray(self._affine).tolist(),
+            'dtype': np.dtype(self._dtype).str,
+            'save_memory': self._save_memory,
+            'shape': None if self._maps is None else list(self._maps.shape),
+            'blocks': self._maps is not None and (block_size is not None or self._is_out_of_core()),
+            'compact': False,
+            'space': self._space,
+            'map_ids': None if self._map_ids is None else len(self._map_ids),
+            'has_mask': self._has_mask(),
+            'has_atlas': self._has_atlas(),
+            'atlas_labels': [str(label) for label in self._atlas.labels] if self._has_atlas() else None,
+            'atlas_bg_label': self._atlas.bg_label,
+            'atlases': [[str(label) for label in a.labels] for a in self._atlases[1:]],
+            'atlas_levels': [[{'labels': [str(label) for label in level['labels']], 'parents': level['parents'].tolist()}
+                              for level in a.levels] for a in self._atlases] if self._has_atlas() else None,
+            'atlas_shape': None if self._maps_atlas is None else list(self._maps_atlas.shape),
+        }
+
+        if header['blocks']:
+            if block_size is None:
+                blocks = (block for block, _ in self._maps.blocks())
+            else:
+                blocks = (self._expand(self._maps[:, k:k+block_size]) for k in range(0, self.n_m, block_size))
+            BlockMatrix.from_blocks(blocks, path=os.path.join(path, 'maps'))
+
+        elif self._maps is not None:
+            header['compact'] = self._is_compact(self._maps)
+            save_sparse('maps', self._maps)
+
+        if self._map_ids is not None:
+            save_array('map_ids', np.asarray(self._map_ids))
+
+        if self._has_mask():
+            save_array('mask', np.asarray(self._mask.dataobj))
+
+        if self._has_atlas():
+            save_array('atlas', self._atlas.data)
+            for k, a in enumerate(self._atlases[1:], start=1):
+                save_array(f'atlas_{k}', a.data)
+            if self._maps_atlas is not None:
+                save_sparse('atlas_maps', self._maps_atlas)
+
+        with open(os.path.join(path, 'header.json'), 'w') as file:
+            json.dump(header, file, indent=4)
+
     def apply_mask(self, mask):
         '''
             Set the contribution of every voxels outside the mask to zero.
@@ -977,18 +1988,192 @@ class Maps:
         if not isinstance(mask, nib.Nifti1Image):
             raise ValueError('Mask must be an instance of nibabel.Nifti1Image')
 
-        if self.maps is not None:
-            mask_array = self._flatten_array(mask.get_fdata()).astype(self._dtype)
+        mask_array = self._flatten_array(mask.get_fdata()).astype(self._dtype)
+
+        if self._is_out_of_core():
             filter_matrix = scipy.sparse.diags(mask_array, format='csr').astype(self._dtype)
-            self.maps = filter_matrix.dot(self.maps)
+            self.maps = self._maps.map_blocks(lambda block, cols: filter_matrix.dot(block))
+
+        else:
+            maps = self.maps
+            if self._compact:
+                self._voxel_ids = np.flatnonzero(mask_array)
+
+            if maps is not None:
+                filter_matrix = scipy.sparse.diags(mask_array, format='csr').astype(self._dtype)
+                self.maps = filter_matrix.dot(maps)
 
         self._mask = mask
 
     def apply_atlas(self, atlas, inplace=False):
         new_maps = self if inplace else copy.copy(self)
-        new_maps._atlas = Atlas(atlas)
+        new_maps._atlases = load_atlases(atlas)
+        new_maps._atlas = new_maps._atlases[0]
         new_maps._atlas_filter_matrix = new_maps._build_atlas_filter_matrix()
-        new_maps._refresh_atlas_maps()
+        new_maps._invalidate_maps(dense=False)
+
+        return new_maps
+
+    def get_maps_atlas(self, atlas_id=0, level=None):
+        '''
+            Return the atlas maps of one of the atlases given at initialization.
+
+            Args:
+                atlas_id (int, optional): Position of the atlas in the list of atlases. Defaults to 0.
+                level (int, optional): If given, position of the coarser level of the atlas in atlas['levels'].
+                    Its maps are aggregated from the atlas maps without going back to the voxels.
+
+            Returns:
+                (scipy.sparse.csr_matrix) Sparse matrix of shape (n_labels, n_maps).
+        '''
+        if not self._has_atlas():
+            raise AttributeError('No atlas were given.')
+
+        if len(self._atlases) == 1:
+            maps = self._maps_atlas
+        else:
+            maps = self._maps_atlas[self._atlas_rows(atlas_id)]
+
+        if level is None:
+            return maps
+
+        return self._atlases[atlas_id].get_level_matrix(level).dot(maps)
+
+    def reduce(self, reduce, inplace=False):
+        '''
+            Aggregate the voxels of the maps every reduce voxels in each direction.
+
+            Values are summed so that the number of peaks of each map is preserved. The box,
+            affine, mask (a voxel is kept if any of its voxels is) and atlas (most frequent
+            label) are reduced accordingly.
+
+            Args:
+                reduce (int): Reducing scale factor.
+                inplace (bool, optional): If True performs the reduction inplace else create a new instance.
+
+            Returns:
+                (Maps) Self or a copy depending on inplace.
+        '''
+        new_maps = self if inplace else copy.copy(self)
+
+        if reduce == 1:
+            return new_maps
+
+        Ni, Nj, Nk = self._Ni, self._Nj, self._Nk
+        reduce_matrix = build_reduce_matrix(Ni, Nj, Nk, reduce, dtype=self._build_dtype())
+        maps = self.maps
+
+        new_maps._Ni, new_maps._Nj, new_maps._Nk, new_maps._affine = reduce_box(Ni, Nj, Nk, self._affine, reduce)
+        new_maps._voxel_ids = None
+        new_maps._maps_dense = None
+
+        if self._has_mask():
+            new_maps._mask = reduce_mask(self._mask, reduce)
+            if self._compact:
+                new_maps._voxel_ids = np.flatnonzero(new_maps._flatten_array(new_maps._mask.get_fdata()))
+
+        if self._has_atlas():
+            new_maps._atlases = [load_atlas(reduce_atlas(a.atlas, reduce), bg_label=a.bg_label) for a in self._atlases]
+            new_maps._atlas = new_maps._atlases[0]
+            new_maps._atlas_filter_matrix = new_maps._build_atlas_filter_matrix()
+
+        if maps is None:
+            new_maps._maps = None
+        elif self._is_out_of_core():
+            new_maps.maps = maps.map_blocks(lambda block, cols: reduce_matrix.dot(block))
+        else:
+            new_maps.maps = reduce_matrix.dot(maps)
+
+        return new_maps
+
+    def append_df(self, df, groupby_col=None, x_col='x', y_col='y',
+                  z_col='z', weight_col='weight', inplace=False):
+        """
+        Add the peaks of a new dataframe to the maps.
+
+        Only the peaks of the given dataframe are processed: maps whose id
+        is not already in map_ids are appended as new columns and the peaks
+        of existing maps are added to them. Atlas maps are only computed
+        for the given peaks. In atlas space, only atlas maps are built.
+
+        Args:
+            df (pandas.DataFrame): Dataframe of the new peaks. See the
+                Maps.__init__ doc for the column names.
+            inplace (bool, optional): If True appends inplace else create a
+                new instance. Defaults to False.
+
+        Returns:
+            (Maps) Self or a copy depending on inplace.
+
+        Raises:
+            ValueError: If the existing maps have no map ids.
+
+        """
+        if groupby_col is None:
+            raise TypeError('Must specify column name to group by maps.')
+
+        if self._affine is None:
+            raise TypeError('Must specify affine to append a dataframe.')
+
+        if self.n_m > 0 and self._map_ids is None:
+            raise ValueError('Maps have no map ids. Can only append a '
+                             'dataframe to maps built from coordinates.')
+
+        col_names = {
+            'groupby': groupby_col,
+            'x': x_col,
+            'y': y_col,
+            'z': z_col,
+            'weight': weight_col
+        }
+
+        map_ids = [] if self._map_ids is None else self._map_ids
+        n_old = len(map_ids)
+
+        def extend(maps, delta):
+            if maps is None:
+                return delta
+
+            if delta[:, :n_old].nnz > 0:
+                maps = maps + delta[:, :n_old]
+
+            return hstack([maps, delta[:, n_old:]], format='csr')
+
+        new_maps = self if inplace else copy.copy(self)
+
+        # In atlas space, only the atlas maps of the peaks are built
+        if self._space == 'atlas':
+            deltas = []
+            for a in self._atlases:
+                delta, df_map_ids = build_atlas_maps_from_df(df, col_names, self._Ni, self._Nj, self._Nk, self._affine,
+                                                             a.get_label_index(), a.n_labels, self._mask,
+                                                             self.verbose, self._build_dtype())
+                deltas.append(delta)
+
+            positions = {map_id: k for k, map_id in enumerate(map_ids)}
+            for map_id in df_map_ids:
+                positions.setdefault(map_id, len(positions))
+            cols = np.array([positions[map_id] for map_id in df_map_ids], dtype=int)
+
+            delta = scipy.sparse.vstack(deltas, format='csr')
+            delta = csr_matrix((delta.data, cols[delta.indices], delta.indptr), shape=(delta.shape[0], len(positions)))
+
+            new_maps._maps_atlas = extend(self._maps_atlas, delta)
+            new_maps._map_ids = list(positions)
+
+            return new_maps
+
+        delta, map_ids = build_maps_from_chunks([df], col_names, self._Ni, self._Nj, self._Nk, self._affine,
+                                                self._mask, self.verbose, self._build_dtype(), map_ids=map_ids)
+
+        new_maps._set_maps(extend(self.maps, delta), refresh_atlas_maps=False)
+        new_maps._map_ids = map_ids
+
+        if self._has_atlas():
+            if self._atlas_filter_matrix is None:
+                new_maps._atlas_filter_matrix = self._build_atlas_filter_matrix()
+            delta_atlas = new_maps._atlas_filter_matrix.dot(delta)
+            new_maps._maps_atlas = extend(self._maps_atlas, delta_atlas)
 
         return new_maps
 
@@ -1067,7 +2252,6 @@ class Maps:
             p = np.ma.masked_array(p, np.logical_not(mask)).filled(0)
             p /= np.sum(p)
 
-        maps = scipy.sparse.dok_matrix((n_voxels, n_maps))
         voxels_samples = np.random.choice(n_voxels, size=n_peaks, p=p)
 
         if isinstance(size, np.ndarray):
@@ -1075,14 +2259,13 @@ class Maps:
         else:
             maps_samples = np.random.choice(n_maps, size=n_peaks)
 
-        for i in range(n_peaks):
-            map_id = maps_samples[i]
-            maps[voxels_samples[i], map_id] += 1
-
-        maps = scipy.sparse.csr_matrix(maps)
+        # Duplicate samples are summed into peak counts
+        maps = scipy.sparse.csr_matrix((np.ones(n_peaks, dtype=np.int64), (voxels_samples, maps_samples)),
+                                       shape=(n_voxels, n_maps))
 
         new_maps = self if inplace else copy.copy(self)
         new_maps.maps = maps
+        new_maps._map_ids = None
 
         return new_maps
 
@@ -1096,14 +2279,24 @@ class Maps:
             Returns:
                 (Maps) Self or a copy depending on inplace.
         '''
-        diag = scipy.sparse.diags(np.power(self.n_peaks(atlas=False), -1))
-
         new_maps = self if inplace else copy.copy(self)
-        new_maps.maps = self._maps.dot(diag)
+        new_maps._set_float_dtype()
+
+        if self._space == 'voxel':
+            diag = scipy.sparse.diags(np.power(self.n_peaks(atlas=False), -1), format='csr')
+            if self._is_out_of_core():
+                new_maps.maps = self._maps.map_blocks(lambda block, cols: block_dot(block, diag[cols, cols]))
+            else:
+                new_maps.maps = self._maps.dot(diag)
 
         if self._has_atlas():
-            diag_atlas = scipy.sparse.diags(np.power(self.n_peaks(atlas=True), -1))
-            new_maps._maps_atlas = self._maps_atlas.dot(diag_atlas)
+            # Atlas maps of each atlas are normalized by their own sums
+            maps_atlas = []
+            for k in range(len(self._atlases)):
+                block = self._maps_atlas[self._atlas_rows(k)]
+                diag_atlas = scipy.sparse.diags(np.power(np.asarray(block.sum(axis=0)).reshape(-1), -1))
+                maps_atlas.append(block.dot(diag_atlas))
+            new_maps._maps_atlas = maps_atlas[0] if len(maps_atlas) == 1 else scipy.sparse.vstack(maps_atlas, format='csr')
 
         return new_maps
 
@@ -1120,82 +2313,133 @@ class Maps:
             Returns:
                 (Maps) Self or a copy depending on inplace.
         '''
+        self._check_voxel_space()
         new_maps = self if inplace else copy.copy(self)
-        new_maps.maps[new_maps.maps < threshold] = 0.
-        return new_maps
-
-    @staticmethod
-    def _smooth_array(array, sigma):
-        return gaussian_filter(array, sigma=sigma)
-
-    @staticmethod
-    def _smooth_map(map, sigma, Ni, Nj, Nk):
-        array = Maps.map_to_array(map, Ni, Nj, Nk)
-        array = Maps._smooth_array(array, sigma=sigma)
-        map = Maps.array_to_map(array)
-        return map
-
-    @staticmethod
-    def _smooth(data, sigma, Ni=None, Nj=None, Nk=None):
-        if sigma is None:
-            return data
 
-        if isinstance(data, np.ndarray):
-            return Maps._smooth_array(data, sigma)
+        def threshold_block(block, cols=None):
+            if isinstance(block, np.ndarray):
+                return np.where(block < threshold, 0, block).astype(block.dtype)
+            block = block.copy()
+            block.data[block.data < threshold] = 0
+            block.eliminate_zeros()
+            return block
 
-        elif scipy.sparse.issparse(data):
-            return Maps._smooth_map(data, sigma, Ni, Nj, Nk)
+        if self._is_out_of_core():
+            new_maps.maps = self._maps.map_blocks(threshold_block)
+        else:
+            new_maps._set_maps(threshold_block(self._maps))
+        return new_maps
 
-    def smooth(self, sigma, map_id=None, inplace=False, verbose=None):
+    def smooth(self, sigma, map_id=None, inplace=False, verbose=None, operator=False, truncate=4.0,
+               rtol=0., atol=0., block_size=None, in_memory=False):
         '''
             Convolve chosen maps with gaussian kernel.
 
             Args:
-                sigma (float): Standard deviation of the gaussian kernel.
+                sigma (float or tuple): Standard deviation of the gaussian kernel, one per axis if a tuple.
                 map_id (int, optional): If None: convolves each maps. If int: convolves only the chosen map. Defaults to None.
                 inplace (bool, optional): If True performs the normalization inplace else create a new instance. Defaults to False
                 verbose (bool, optional): If True print logs.
+                operator (bool, optional): If True, maps are smoothed in one sparse product with the smoothing operator of the box, mask and sigma, built once and cached on disk (see build_smoothing_operator). Values smoothed out of the mask are then dropped. The operator holds about n_mask_voxels*(2*truncate*sigma+1)**3 values. Defaults to False.
+                truncate (float, optional): With operator, the kernel is truncated at this many sigmas. Defaults to 4.0 as gaussian_filter.
+                rtol (float, optional): Smoothed values v of a map of maximum absolute value m are dropped when |v| <= max(atol, rtol*m), so that the smoothed maps only store the support of the signal instead of the whole box. Defaults to 0.
+                atol (float, optional): Absolute tolerance, see rtol. Defaults to 0.
+                block_size (int, optional): If given, the smoothed maps are stored out-of-core in blocks of block_size maps (see Maps.save), each block being stored as a dense array when sparsity would not pay off (see blocks.dense_pays). Out-of-core maps keep their blocks if None.
+                in_memory (bool, optional): If True, the blocks of block_size maps (all maps in one block if block_size is None) are held in memory instead of on disk, dense ones as numpy arrays. Defaults to False.
 
         '''
+        self._check_voxel_space()
         verbose = self._should_verbose(verbose)
 
-        if map_id is None:
-            map_ids = range(self.n_maps)
+        new_maps = self if inplace else copy.copy(self)
+        new_maps._set_float_dtype()
+
+        if operator:
+            print_percent(string='Building smoothing operator...', verbose=verbose, prefix='Maps')
+            voxel_ids = self._voxel_ids
+            if voxel_ids is None and self._has_mask():
+                voxel_ids = np.flatnonzero(self._flatten_array(self._mask.get_fdata()))
+            smoothing_operator = build_smoothing_operator(self._Ni, self._Nj, self._Nk, sigma,
+                                                          truncate=truncate, voxel_ids=voxel_ids)
+            nb_jobs = max(1, multiprocessing.cpu_count()//2)
+
+            def smooth_maps(maps, map_ids=None):
+                maps = self._expand(maps)
+                if map_ids is not None:
+                    maps = maps[:, np.asarray(map_ids, dtype=int)]
+                smoothed = apply_operator(smoothing_operator, maps, n_jobs=nb_jobs)
+                if not rtol and not atol:
+                    return smoothed
+                if isinstance(smoothed, np.ndarray):
+                    smoothed[negligible(smoothed, rtol=rtol, atol=atol)] = 0
+                    return smoothed
+                return sparsify(smoothed, rtol=rtol, atol=atol).tocsr()
+
+        else:
+            def smooth_maps(maps, map_ids=None):
+                return self._smooth_maps(maps, sigma, map_ids=map_ids, verbose=verbose, rtol=rtol, atol=atol)
+
+        if map_id is None and (block_size is not None or in_memory):
+            block_size = block_size or max(self.n_m, 1)
+            blocks = (smooth_maps(self._maps, map_ids=range(k, min(k+block_size, self.n_m)))
+                      for k in range(0, self.n_m, block_size))
+            new_maps.maps = BlockMatrix.from_blocks(blocks, in_memory=in_memory)
+        elif map_id is None and self._is_out_of_core():
+            new_maps.maps = self._maps.map_blocks(lambda block, cols: smooth_maps(block))
         else:
-            map_ids = [map_id]
+            map_ids = None if map_id is None else [map_id]
+            new_maps.maps = smooth_maps(self._maps, map_ids=map_ids)
+
+        return new_maps
 
-        def smooth_pool(map_ids, self, sigma):
+    def _smooth_maps(self, maps, sigma, map_ids=None, verbose=False, rtol=0., atol=0.):
+        '''
+            Convolve the chosen columns of the given maps with a gaussian kernel.
 
-            csc_matrices = []
-            n_tot = len(map_ids)
-            count = 0
-            for k in map_ids:
-                print_percent(count, n_tot, 'Smoothing {1} out of {2}... {0:.1f}%', rate=0, verbose=verbose, prefix='Maps')
-                count += 1
+            Maps with few nonzero voxels are smoothed by stamping the kernel on them (see
+            smoothing.stamp_smooth), the others are filtered by blocks in a pool of threads
+            (see smoothing.dense_smooth). Negligible values are dropped according to rtol
+            and atol (see smoothing.sparsify). Maps are returned unchanged if sigma is 0.
 
-                if not self.save_memory:
-                    array = self._get_maps(map_id=k, dense=True)
-                else:
-                    array = self.to_array(k)
+            Returns a sparse CSR matrix of shape (n_voxels, len(map_ids)), or a numpy array
+            if the given maps are a dense block.
+        '''
+        if map_ids is None:
+            map_ids = range(maps.shape[1])
+        map_ids = np.asarray(map_ids, dtype=int)
 
-                array_smoothed = gaussian_filter(array, sigma=sigma)
-                array_smoothed = self._flatten_array(array_smoothed, _2D=1)
-                matrix = scipy.sparse.csc_matrix(array_smoothed)
-                csc_matrices.append(matrix)
+        shape = (self._Ni, self._Nj, self._Nk)
+        maps = self._expand(maps)[:, map_ids]
+        nb_jobs = max(1, multiprocessing.cpu_count()//2)
 
-            return csc_matrices
+        if isinstance(maps, np.ndarray):
+            # Dense blocks stay dense and are filtered as they are, stamping would not pay off
+            if not np.any(sigma):
+                return maps
+            print_percent(string=f'Smoothing {len(map_ids)} dense maps...', verbose=verbose, prefix='Maps')
+            return dense_smooth(maps.reshape(shape+(-1,), order='F'), shape, sigma, n_jobs=nb_jobs,
+                                rtol=rtol, atol=atol, dense=True)
 
-        nb_jobs = multiprocessing.cpu_count()//2
-        splitted_range = np.array_split(map_ids, nb_jobs)
-        csc_matrices = np.concatenate(Parallel(n_jobs=nb_jobs, backend='threading')(delayed(smooth_pool)(sub_array, self, sigma) for sub_array in splitted_range))
+        if not np.any(sigma):
+            return scipy.sparse.csr_matrix(maps)
 
-        csr_maps = scipy.sparse.hstack(csc_matrices)
-        csr_maps = scipy.sparse.csr_matrix(csr_maps)
+        maps = scipy.sparse.csc_matrix(maps)
 
-        new_maps = self if inplace else copy.copy(self)
-        new_maps.maps = csr_maps
+        stamp = np.zeros(len(map_ids), dtype=bool)
+        if np.isscalar(sigma):
+            stamp = use_stamping(np.diff(maps.indptr), shape, sigma)
+        filtered = np.flatnonzero(~stamp)
 
-        return new_maps
+        print_percent(string=f'Smoothing {len(map_ids)} maps ({np.sum(stamp)} stamped)...', verbose=verbose, prefix='Maps')
+        csc_matrices = [dense_smooth(maps[:, filtered], shape, sigma, n_jobs=nb_jobs, rtol=rtol, atol=atol)]
+        if stamp.any():
+            csc_matrices.insert(0, sparsify(stamp_smooth(maps[:, stamp], shape, sigma), rtol=rtol, atol=atol))
+
+        # Back to the order of map_ids
+        order = np.argsort(np.concatenate([np.flatnonzero(stamp), filtered]), kind='stable')
+        csc_maps = scipy.sparse.hstack(csc_matrices, format='csc')[:, order]
+
+        return scipy.sparse.csr_matrix(csc_maps)
 
     def split(self, prop=0.5, random_state=None):
         """
@@ -1229,8 +2473,21 @@ class Maps:
         filter_matrix_A = filter_matrix(id_sub_maps_A)
         filter_matrix_B = filter_matrix(id_sub_maps_B)
 
-        maps_A.maps = self.maps.dot(filter_matrix_A)
-        maps_B.maps = self.maps.dot(filter_matrix_B)
+        if self._space == 'atlas':
+            maps_A._maps_atlas = self._maps_atlas.dot(filter_matrix_A)
+            maps_B._maps_atlas = self._maps_atlas.dot(filter_matrix_B)
+        elif self._is_out_of_core():
+            # Ids are sorted so that each subset keeps the columns of each block in order
+            in_A = np.isin(omega, id_sub_maps_A)
+            maps_A.maps = self._maps.map_blocks(lambda block, cols: block[:, in_A[cols]])
+            maps_B.maps = self._maps.map_blocks(lambda block, cols: block[:, ~in_A[cols]])
+        else:
+            maps_A.maps = self._maps.dot(filter_matrix_A)
+            maps_B.maps = self._maps.dot(filter_matrix_B)
+
+        if self._map_ids is not None:
+            maps_A._map_ids = [self._map_ids[k] for k in id_sub_maps_A]
+            maps_B._map_ids = [self._map_ids[k] for k in id_sub_maps_B]
 
         return maps_A, maps_B
 
@@ -1242,7 +2499,14 @@ class Maps:
 
         Arguments:
             random_state {int} -- Used to initialize the numpy random seed.
+
+        Raises:
+            ValueError: If the maps are out-of-core, since shuffling them
+                would gather every block in memory.
         """
+        if self._is_out_of_core():
+            raise ValueError('Out-of-core maps can not be shuffled. Load them in memory first.')
+
         np.random.seed(random_state)
 
         new_maps = self if inplace else copy.copy(self)
@@ -1253,7 +2517,13 @@ class Maps:
             M[k, permutation[k]] = 1.
         M = scipy.sparse.csr_matrix(M)
 
-        new_maps.maps = new_maps.maps.dot(M)
+        if new_maps._space == 'atlas':
+            new_maps._maps_atlas = new_maps._maps_atlas.dot(M)
+        else:
+            new_maps.maps = new_maps._maps.dot(M)
+
+        if new_maps._map_ids is not None:
+            new_maps._map_ids = [new_maps._map_ids[k] for k in np.argsort(permutation)]
 
         return new_maps
 
@@ -1282,6 +2552,13 @@ class Maps:
         max = copy.copy(maps).max(**kwargs)
         if isinstance(max, scipy.sparse.coo.coo_matrix):
             max = max.toarray()
+
+        if not atlas and self._is_compact(maps):
+            if kwargs.get('axis') == 1:
+                max = self._expand(max)
+            elif len(self._voxel_ids) < self.prod_N:
+                max = np.maximum(max, 0)  # Voxels outside the mask are zeros
+
         return max
 
     def sum(self, atlas=False, axis=None, keepdims=False):
@@ -1296,6 +2573,13 @@ class Maps:
         '''
         maps = self._get_maps(atlas=atlas)
 
+        if isinstance(maps, BlockMatrix):
+            if axis not in [None, 0, 1]:
+                raise ValueError('Axis must be None, 0 or 1.')
+
+            maps = maps.sum(axis=axis)
+            return maps if keepdims else np.squeeze(maps)
+
         e1 = scipy.sparse.csr_matrix(np.ones((1, maps.shape[0])))
         e2 = scipy.sparse.csr_matrix(np.ones((maps.shape[1], 1)))
 
@@ -1305,6 +2589,9 @@ class Maps:
         if axis is None or axis == 1:
             maps = maps.dot(e2)
 
+        if not atlas and axis == 1:
+            maps = self._expand(maps)
+
         if axis not in [None, 0, 1]:
             raise ValueError('Axis must be None, 0 or 1.')
 
@@ -1348,9 +2635,20 @@ class Maps:
         _, n_maps = maps.shape
 
         avg_map = Maps._average(maps)
-        maps_squared = maps.multiply(maps)  # Squared element wise
 
-        avg_squared_map = Maps._average(maps_squared)
+        if isinstance(maps, BlockMatrix):
+            e = scipy.sparse.csr_matrix(np.ones(n_maps)/n_maps).transpose()
+
+            def avg_squared(block, cols):
+                block = Maps._widen(block)
+                squared = np.square(block) if isinstance(block, np.ndarray) else block.power(2)
+                return scipy.sparse.csr_matrix(block_dot(squared, e[cols]))
+
+            avg_squared_map = maps.reduce(avg_squared)
+        else:
+            maps = Maps._widen(maps)
+            maps_squared = maps.multiply(maps)  # Squared element wise
+            avg_squared_map = Maps._average(maps_squared)
         squared_avg_map = avg_map.multiply(avg_map)
 
         var = avg_squared_map - squared_avg_map
@@ -1368,7 +2666,9 @@ class Maps:
                 (Maps) New Maps instance containing the average map.
         '''
         avg_map = Maps.copy_header(self)
-        avg_map.maps = self._average(self.maps)
+        avg_map._set_float_dtype()
+        if self._space == 'voxel':
+            avg_map.maps = self._average(self._maps)
         if self._has_atlas():
             avg_map._maps_atlas = self._average(self._maps_atlas)
 
@@ -1385,7 +2685,9 @@ class Maps:
                 (Maps) New Maps instance containing the variance map.
         '''
         var_map = Maps.copy_header(self)
-        var_map.maps = self._variance(self._maps, bias=bias)
+        var_map._set_float_dtype()
+        if self._space == 'voxel':
+            var_map.maps = self._variance(self._maps, bias=bias)
         if self._has_atlas():
             var_map._maps_atlas = self._variance(self._maps_atlas, bias=bias)
 
@@ -1415,18 +2717,19 @@ class Maps:
 
         verbose = self._should_verbose(verbose)
 
-        maps = self._get_maps(atlas=atlas)
+        maps = self._widen(self._get_maps(atlas=atlas))
         ddof = 0 if bias else 1
 
         if atlas:
             labels = self._atlas.get_labels(ignore_bg=ignore_bg)
             if ignore_bg and self._atlas.has_background():
+                maps = maps.copy()  # Atlas maps may be the only stored maps
                 maps[self._atlas.bg_index, :] = 0
 
         if verbose:
             print('Computing cov matrix')
-        e1 = scipy.sparse.csr_matrix(np.ones(self.n_maps)/(self.n_maps-ddof)).transpose().astype(self._dtype)
-        e2 = scipy.sparse.csr_matrix(np.ones(self.n_maps)/(self.n_maps)).transpose().astype(self._dtype)
+        e1 = scipy.sparse.csr_matrix(np.ones(self.n_maps)/(self.n_maps-ddof)).transpose().astype(maps.dtype)
+        e2 = scipy.sparse.csr_matrix(np.ones(self.n_maps)/(self.n_maps)).transpose().astype(maps.dtype)
 
         M1 = maps.dot(e1)
         M2 = maps.dot(e2)
@@ -1437,6 +2740,9 @@ class Maps:
 
         del M1, M2, M3
 
+        if not atlas:
+            S = self._expand(self._expand(S).transpose()).transpose()
+
         print('To dense...') if verbose else None
         if not sparse:
             S = S.toarray()
@@ -1448,67 +2754,73 @@ class Maps:
         return S, labels if atlas else S
 
     @staticmethod
-    def _power(map, n):
-        if scipy.sparse.issparse(map):
-            return map.power(n)
-
-        elif isinstance(map, np.ndarray):
-            return np.power(map, n)
-
-        else:
-            raise ValueError('Given map type not supported for power : {}'.format(type(map)))
-
-    @staticmethod
-    def _iterative_avg(k, previous_avg, new_value):
-        if k == 1:
-            return new_value
-        return 1./k*((k-1)*previous_avg + new_value)
+    def _merge_avg_m2(n, avg, m2, block):
+        '''
+            Merge the average and sum of squared deviations of n values with the ones
+            of the columns of the given block (Chan et al. parallel algorithm).
+        '''
+        n_block = block.shape[1]
+        avg_block = block.mean(axis=1)
+        m2_block = np.square(block - avg_block[:, None]).sum(axis=1)
 
-    @staticmethod
-    def _iterative_var(k, previous_var, new_avg, new_value, bias=False):
-        if k == 1:
-            return 0*new_value
+        delta = avg_block - avg
+        avg = avg + delta*n_block/(n+n_block)
+        m2 = m2 + m2_block + np.square(delta)*n*n_block/(n+n_block)
 
-        if bias:
-            return (k-1)/(k)*previous_var + 1./(k*(k-1))*Maps._power(new_avg - new_value, 2) + 1./(k)*Maps._power(new_value - new_avg, 2)
-        else:
-            return (k-2)/(k-1)*previous_var + 1./((k-1)**2)*Maps._power(new_avg - new_value, 2) + 1./(k-1)*Maps._power(new_value - new_avg, 2)
+        return avg, m2
 
-    def iterative_smooth_avg_var(self, compute_var=True, sigma=None, bias=False, verbose=None):
+    def iterative_smooth_avg_var(self, compute_var=True, sigma=None, bias=False, verbose=None, max_bytes=2**27):
         '''
             Compute average and variance of the maps in self.maps (previously smoothed if sigma!=None) iteratively.
             (Less memory usage).
+
+            Maps are smoothed by blocks filtered at once in a buffer of at most max_bytes
+            (see smoothing.smooth_block) and the statistics of the blocks are merged.
         '''
+        self._check_voxel_space()
         verbose = self._should_verbose(verbose)
 
         if not compute_var:
             return self.avg().smooth(sigma=sigma), None
 
-        avg_map = None
-        var_map = None
-        avg_map_atlas = None
-        var_map_atlas = None
+        shape = (self._Ni, self._Nj, self._Nk)
+        size = batch_size(shape, max_bytes=max_bytes)
+        buffer = np.zeros(shape+(size,), order='F')
+        ddof = 0 if bias else 1
+
+        # Running averages and sums of squared deviations, merged block by block
+        avg_map, m2_map = np.zeros(self.prod_N), np.zeros(self.prod_N)
+        if self._has_atlas():
+            if self._atlas_filter_matrix is None:
+                self._atlas_filter_matrix = self._build_atlas_filter_matrix()
+            n_labels = self._atlas_filter_matrix.shape[0]
+            avg_map_atlas, m2_map_atlas = np.zeros(n_labels), np.zeros(n_labels)
 
-        for k in range(self.n_maps):
-            print_percent(k, self.n_maps, 'Iterative smooth avg var {1} out of {2}... {0:.1f}%', rate=0, verbose=verbose, prefix='Maps')
+        for start in range(0, self.n_maps, size):
+            stop = min(start+size, self.n_maps)
+            print_percent(start, self.n_maps, 'Iterative smooth avg var {1} out of {2}... {0:.1f}%', rate=0, verbose=verbose, prefix='Maps')
 
-            current_map = self._get_maps(map_id=k, atlas=False, dense=not self.save_memory)
-            current_map = self._smooth(current_map, sigma, self._Ni, self._Nj, self._Nk)
+            block = smooth_block(self._expand(self._maps[:, start:stop]), shape, sigma, buffer)
 
-            avg_map = self._iterative_avg(k+1, avg_map, current_map)
-            var_map = self._iterative_var(k+1, var_map, avg_map, current_map, bias=bias)
+            avg_map, m2_map = self._merge_avg_m2(start, avg_map, m2_map, block)
 
             if self._has_atlas():
-                current_map_atlas = self._to_map_atlas(current_map)
-                avg_map_atlas = self._iterative_avg(k+1, avg_map_atlas, current_map_atlas)
-                var_map_atlas = self._iterative_var(k+1, var_map_atlas, avg_map_atlas, current_map_atlas, bias=bias)
+                block_atlas = self._atlas_filter_matrix.dot(block)
+                avg_map_atlas, m2_map_atlas = self._merge_avg_m2(start, avg_map_atlas, m2_map_atlas, block_atlas)
+
+        var_map = m2_map/max(self.n_maps-ddof, 1)
+        avg_map = scipy.sparse.csr_matrix(avg_map[:, None])
+        var_map = scipy.sparse.csr_matrix(var_map[:, None])
+
+        if self._has_atlas():
+            var_map_atlas = m2_map_atlas/max(self.n_maps-ddof, 1)
+            avg_map_atlas = scipy.sparse.csr_matrix(avg_map_atlas[:, None])
+            var_map_atlas = scipy.sparse.csr_matrix(var_map_atlas[:, None])
 
         avg = Maps.copy_header(self)
         var = Maps.copy_header(self)
-
-        if not self.save_memory:
-            avg_map = self.array_to_map(avg_map)
-            var_map = self.array_to_map(var_map)
+        avg._set_float_dtype()
+        var._set_float_dtype()
 
         avg._set_maps(avg_map, refresh_atlas_maps=False)
         var._set_maps(var_map, refresh_atlas_maps=False)
@@ -0,0 +1,309 @@
+"""Implement a sparse matrix stored by blocks of columns, on disk or in memory."""
+import os
+import json
+import shutil
+import weakref
+import tempfile
+import numpy as np
+import scipy.sparse
+
+
+def dense_pays(nnz, shape, dtype=np.float64):
+    """
+    Return whether a matrix takes less space stored densely than in CSR format.
+
+    A CSR matrix stores an int32 index along with each nonzero value.
+
+    Args:
+        nnz (int): Number of nonzero values.
+        shape (tuple): Shape of the matrix.
+        dtype (numpy.dtype): Type of the values.
+
+    Returns:
+        (bool)
+
+    """
+    itemsize = np.dtype(dtype).itemsize
+    return nnz*(itemsize+4) > int(np.prod(shape))*itemsize
+
+
+def block_dot(block, other):
+    """
+    Return the product of a block with a sparse matrix.
+
+    Args:
+        block (scipy.sparse matrix or numpy.ndarray): Block of shape (n, p).
+        other (scipy.sparse matrix): Matrix of shape (p, q).
+
+    Returns:
+        (scipy.sparse matrix or numpy.ndarray) Product of shape (n, q), dense
+            if the block is.
+
+    """
+    if isinstance(block, np.ndarray):
+        return np.asarray(other.T.dot(block.T)).T
+    return block.dot(other)
+
+
+def block_add(block, other):
+    """
+    Return the sum of a block with a sparse matrix of the same shape.
+
+    Args:
+        block (scipy.sparse matrix or numpy.ndarray): Block of shape (n, p).
+        other (scipy.sparse matrix): Matrix of shape (n, p).
+
+    Returns:
+        (scipy.sparse matrix or numpy.ndarray) Sum of shape (n, p), dense
+            if the block is.
+
+    """
+    if isinstance(block, np.ndarray):
+        return block + other.toarray()
+    return block + other
+
+
+def _reduce_axis(block, func, axis):
+    """Apply the reduction func ('sum' or 'max') along axis keeping a 2D numpy array."""
+    if isinstance(block, np.ndarray):
+        return np.asarray(getattr(block, func)(axis=axis, keepdims=True))
+    value = getattr(block, func)(axis=axis)
+    return value.toarray() if scipy.sparse.issparse(value) else np.asarray(value)
+
+
+class BlockMatrix:
+    """
+    Sparse matrix of shape (n_rows, n_cols) stored on disk in shards.
+
+    Each shard stores a block of consecutive columns, as a CSR matrix in a
+    npz file or as a dense array in a npy file when sparsity would not pay
+    off (see dense_pays). Dense blocks are loaded as memory-mapped numpy
+    arrays and are never converted to sparse matrices. Operations are
+    streaming passes over the blocks so that only one block is held in
+    memory at a time. Blocks may also be held in memory instead of on disk
+    (see from_blocks).
+    """
+
+    def __init__(self, path, temporary=False, header=None, blocks=None):
+        """
+        Args:
+            path (str): Directory of the shards, written by
+                BlockMatrix.from_blocks. None if the blocks are held in
+                memory.
+            temporary (bool): If True, the directory is removed when the
+                object is garbage collected.
+            header (dict): Header of the blocks held in memory, read from
+                the directory if None.
+            blocks (list): Blocks held in memory, CSR matrices or numpy
+                arrays.
+
+        """
+        if header is None:
+            with open(os.path.join(path, 'blocks.json'), 'r') as file:
+                header = json.load(file)
+
+        self.path = path
+        self._blocks = blocks
+        self.bounds = header['bounds']
+        self.shape = (header['n_rows'], self.bounds[-1])
+        self.dtype = np.dtype(header['dtype'])
+        self.nnz = sum(header['nnz'])
+        self.dense = header.get('dense', [False]*self.n_blocks)
+        self._last_block = (None, None)
+
+        if temporary:
+            weakref.finalize(self, shutil.rmtree, path, True)
+
+    @classmethod
+    def from_blocks(cls, blocks, path=None, dir=None, dense='auto', in_memory=False):
+        """
+        Write the given blocks of columns in shards.
+
+        Args:
+            blocks (iterable): Sparse matrices or 2D arrays with the same
+                number of rows.
+            path (str): Directory to write the shards in. If None, a
+                temporary directory is created in dir and removed when the
+                returned object is garbage collected.
+            dir (str): Parent directory of the temporary directory.
+            dense (bool or str): If True, blocks are stored densely, if
+                False as CSR matrices. If 'auto', each block is stored
+                densely when sparsity would not pay off.
+            in_memory (bool): If True, the blocks are held in memory instead
+                of being written on disk, path and dir being ignored.
+
+        Returns:
+            (BlockMatrix) Instance of BlockMatrix.
+
+        """
+        temporary = path is None and not in_memory
+        if in_memory:
+            path = None
+        elif temporary:
+            path = tempfile.mkdtemp(prefix='blocks_', dir=dir)
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+
+        bounds, nnz, dense_blocks, stored = [0], [], [], []
+        n_rows, dtype = None, None
+
+        for k, block in enumerate(blocks):
+            block_nnz = np.count_nonzero(block) if isinstance(block, np.ndarray) else block.count_nonzero()
+            block_dense = bool(dense_pays(block_nnz, block.shape, block.dtype) if dense == 'auto' else dense)
+
+            if block_dense:
+                block = np.asarray(block) if isinstance(block, np.ndarray) else block.toarray()
+            else:
+                block = scipy.sparse.csr_matrix(block)
+
+            if in_memory:
+                stored.append(block)
+            elif block_dense:
+                np.save(os.path.join(path, f'block_{k}.npy'), block)
+            else:
+                scipy.sparse.save_npz(os.path.join(path, f'block_{k}.npz'), block, compressed=False)
+
+            bounds.append(bounds[-1]+block.shape[1])
+            nnz.append(int(block_nnz))
+            dense_blocks.append(block_dense)
+            n_rows, dtype = block.shape[0], block.dtype
+
+        if n_rows is None:
+            raise ValueError('No blocks given.')
+
+        header = {'n_rows': int(n_rows), 'bounds': bounds, 'dtype': np.dtype(dtype).str, 'nnz': nnz,
+                  'dense': dense_blocks}
+
+        if in_memory:
+            return cls(None, header=header, blocks=stored)
+
+        with open(os.path.join(path, 'blocks.json'), 'w') as file:
+            json.dump(header, file)
+
+        return cls(path, temporary=temporary)
+
+    @property
+    def n_blocks(self):
+        return len(self.bounds)-1
+
+    @property
+    def in_memory(self):
+        return self._blocks is not None
+
+    def block(self, k):
+        """Load the k-th block in memory, as a numpy array if stored densely else as a CSR matrix."""
+        if self.in_memory:
+            return self._blocks[k]
+
+        if self._last_block[0] != k:
+            if self.dense[k]:
+                block = np.load(os.path.join(self.path, f'block_{k}.npy'), mmap_mode='r')
+            else:
+                block = scipy.sparse.load_npz(os.path.join(self.path, f'block_{k}.npz')).tocsr()
+            self._last_block = (k, block)
+        return self._last_block[1]
+
+    def blocks(self):
+        """Iterate over the blocks, yielding (block, cols) with cols the slice of its columns."""
+        for k in range(self.n_blocks):
+            yield self.block(k), slice(self.bounds[k], self.bounds[k+1])
+
+    def map_blocks(self, func, path=None, dir=None):
+        """
+        Apply func(block, cols) to each block and store the results alike.
+
+        Args:
+            func (callable): Function of a block and the slice of its
+                columns returning the new block.
+            path (str): Directory to write the resulting shards in.
+            dir (str): Parent directory of the temporary directory created
+                if path is None, the system temporary directory if None.
+
+        Returns:
+            (BlockMatrix) The resulting matrix, in memory if self is, else
+                on disk and temporary if path is None.
+
+        """
+        results = (func(block, cols) for block, cols in self.blocks())
+        if self.in_memory:
+            return BlockMatrix.from_blocks(results, in_memory=True)
+        return BlockMatrix.from_blocks(results, path=path, dir=dir)
+
+    def reduce(self, func):
+        """Return the sum over the blocks of func(block, cols)."""
+        res = None
+        for block, cols in self.blocks():
+            value = func(block, cols)
+            res = value if res is None else res + value
+        return res
+
+    def hstack(self, func):
+        """Return the in memory horizontal stack of func(block, cols) over the blocks."""
+        return scipy.sparse.hstack([scipy.sparse.csr_matrix(func(block, cols)) for block, cols in self.blocks()],
+                                   format='csr')
+
+    def dot(self, other):
+        """Return the in memory product with a sparse matrix of shape (n_cols, q) as a CSR matrix."""
+        return self.reduce(lambda block, cols: scipy.sparse.csr_matrix(block_dot(block, other[cols])))
+
+    def sum(self, axis=None):
+        """Return the sum as a 2D numpy array."""
+        if axis is None:
+            return np.array([[self.reduce(lambda block, cols: block.sum())]])
+
+        if axis == 0:
+            return np.concatenate([_reduce_axis(block, 'sum', 0) for block, _ in self.blocks()], axis=1)
+
+        return self.reduce(lambda block, cols: _reduce_axis(block, 'sum', 1))
+
+    def max(self, axis=None):
+        """Return the maximum, a scalar if axis is None else a 2D numpy array."""
+        if axis is None:
+            return max(block.max() for block, _ in self.blocks())
+
+        if axis == 0:
+            return np.concatenate([_reduce_axis(block, 'max', 0) for block, _ in self.blocks()], axis=1)
+
+        return np.max(np.concatenate([_reduce_axis(block, 'max', 1) for block, _ in self.blocks()], axis=1),
+                      axis=1, keepdims=True)
+
+    def astype(self, dtype):
+        """Return self if dtype matches, else a converted temporary copy."""
+        if np.dtype(dtype) == self.dtype:
+            return self
+        return self.map_blocks(lambda block, cols: block.astype(dtype))
+
+    def count_nonzero(self):
+        return self.reduce(lambda block, cols: np.count_nonzero(block) if isinstance(block, np.ndarray)
+                           else block.count_nonzero())
+
+    def toarray(self):
+        """Return the dense matrix, filled block by block."""
+        array = np.zeros(self.shape, dtype=self.dtype)
+        for block, cols in self.blocks():
+            array[:, cols] = block if isinstance(block, np.ndarray) else block.toarray()
+        return array
+
+    def __getitem__(self, key):
+        rows, cols = key
+        if rows != slice(None):
+            raise IndexError('Only columns can be indexed.')
+
+        if isinstance(cols, (int, np.integer)):
+            cols = [cols]
+
+        cols = np.arange(self.shape[1])[cols]
+        columns = []
+        for col in cols:
+            k = np.searchsorted(self.bounds, col, side='right')-1
+            columns.append(scipy.sparse.csr_matrix(self.block(k)[:, [col-self.bounds[k]]]))
+
+        if not columns:
+            return scipy.sparse.csr_matrix((self.shape[0], 0), dtype=self.dtype)
+
+        return scipy.sparse.hstack(columns, format='csr')
+
+    def __repr__(self):
+        return (f'<{self.shape[0]}x{self.shape[1]} sparse matrix of type {self.dtype} '
+                f'with {self.nnz} stored elements in {self.n_blocks} blocks ({sum(self.dense)} dense) '
+                + ('in memory>' if self.in_memory else f'on disk at {self.path}>'))
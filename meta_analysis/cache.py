@@ -0,0 +1,201 @@
+"""Implement a disk cache with cheap content-addressed keys."""
+import os
+import hashlib
+import inspect
+import weakref
+import functools
+import joblib
+import numpy as np
+import pandas as pd
+import nibabel as nib
+
+
+_fingerprints = dict()
+
+
+def _hash_array(array):
+    array = np.ascontiguousarray(array)
+    h = hashlib.sha1()
+    h.update(str((array.dtype.str, array.shape)).encode())
+    h.update(array.reshape(-1).view(np.uint8))
+    return h.hexdigest()
+
+
+def _read_only(array):
+    """Return whether neither the array nor the arrays it is a view of can be written."""
+    while isinstance(array, np.ndarray):
+        if array.flags.writeable:
+            return False
+        array = array.base
+    return True
+
+
+def _memoized(obj, compute):
+    """Return compute(obj) computed once for the lifetime of obj."""
+    key = id(obj)
+
+    if key not in _fingerprints:
+        _fingerprints[key] = compute(obj)
+        weakref.finalize(obj, _fingerprints.pop, key, None)
+
+    return _fingerprints[key]
+
+
+def _compute_fingerprint(obj):
+    if isinstance(obj, pd.DataFrame):
+        h = hashlib.sha1()
+        h.update(str((list(obj.columns), [str(d) for d in obj.dtypes])).encode())
+        h.update(_hash_array(pd.util.hash_pandas_object(obj, index=True).values).encode())
+        return h.hexdigest()
+
+    if isinstance(obj, nib.spatialimages.SpatialImage):
+        # Data read from a file through a proxy or in a read-only array cannot change inplace
+        if nib.is_proxy(obj.dataobj) or _read_only(obj.dataobj):
+            data_fp = _memoized(obj, lambda img: _hash_array(np.asarray(img.dataobj)))
+        else:
+            data_fp = _hash_array(np.asarray(obj.dataobj))
+        h = hashlib.sha1()
+        h.update(data_fp.encode())
+        h.update(_hash_array(obj.affine).encode())
+        return h.hexdigest()
+
+    if isinstance(obj, np.ndarray) and obj.dtype != object:
+        return _memoized(obj, _hash_array) if _read_only(obj) else _hash_array(obj)
+
+    return None
+
+
+def fingerprint(obj):
+    """
+    Return a stable fingerprint of the content of the given object.
+
+    DataFrames, images and arrays are hashed from their content. The hashes
+    of read-only arrays and of the data of images read from files are
+    computed once for the lifetime of the object, as they cannot change
+    inplace; the other objects are hashed at each call so that inplace
+    modifications are detected. Other objects are hashed by joblib.
+
+    Args:
+        obj: Any picklable object.
+
+    Returns:
+        (str) Hexadecimal fingerprint.
+
+    """
+    fp = _compute_fingerprint(obj)
+
+    if fp is None:
+        return joblib.hash(obj)
+
+    return fp
+
+
+class Cache:
+    """Disk cache of function results keyed by the fingerprints of their arguments."""
+
+    def __init__(self, location=None, bytes_limit=None):
+        """
+        Args:
+            location (str): Directory storing the cached results. If None,
+                results are not cached.
+            bytes_limit (int): Maximum size of the cache in bytes. Least
+                recently used results are evicted above it. If None, no limit.
+
+        """
+        self.location = location
+        self.bytes_limit = bytes_limit
+        self.hits = 0
+        self.misses = 0
+
+    def cache(self, func=None, ignore=None):
+        """
+        Decorate a function to cache its results.
+
+        Args:
+            func (callable): Function to decorate.
+            ignore (list): Names of the arguments not used in the key.
+
+        Returns:
+            (callable) Decorated function. The original function is stored
+                in its func attribute.
+
+        """
+        if func is None:
+            return functools.partial(self.cache, ignore=ignore)
+
+        ignore = [] if ignore is None else ignore
+        signature = inspect.signature(func)
+        name = f'{func.__module__}.{func.__qualname__}'
+        # Results are invalidated when the code of the function changes
+        code = hashlib.sha1(func.__code__.co_code).hexdigest()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if self.location is None:
+                return func(*args, **kwargs)
+
+            arguments = signature.bind(*args, **kwargs)
+            arguments.apply_defaults()
+            key = joblib.hash([code]+[(k, fingerprint(v)) for k, v in arguments.arguments.items() if k not in ignore])
+            path = os.path.join(self.location, name, f'{key}.pkl')
+
+            if os.path.exists(path):
+                self.hits += 1
+                os.utime(path)
+                return joblib.load(path)
+
+            self.misses += 1
+            result = func(*args, **kwargs)
+            self._store(path, result)
+
+            return result
+
+        wrapper.func = func
+        return wrapper
+
+    def _store(self, path, result):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f'{path}.{os.getpid()}.tmp'
+        joblib.dump(result, tmp_path)
+        os.replace(tmp_path, path)
+
+        self._evict(keep=path)
+
+    def _entries(self):
+        entries = []
+        for dirpath, _, filenames in os.walk(self.location):
+            for filename in filenames:
+                if filename.endswith('.pkl'):
+                    stat = os.stat(os.path.join(dirpath, filename))
+                    entries.append((stat.st_mtime, stat.st_size, os.path.join(dirpath, filename)))
+        return entries
+
+    def _evict(self, keep=None):
+        if self.bytes_limit is None:
+            return
+
+        entries = sorted(self._entries())
+        size = sum(entry[1] for entry in entries)
+
+        for _, entry_size, path in entries:
+            if size <= self.bytes_limit:
+                break
+            if path == keep:
+                continue
+            os.remove(path)
+            size -= entry_size
+
+    def size(self):
+        """Return the size of the cached results in bytes."""
+        if self.location is None or not os.path.exists(self.location):
+            return 0
+        return sum(entry[1] for entry in self._entries())
+
+    def clear(self):
+        """Remove all the cached results and reset the counters."""
+        if self.location is not None and os.path.exists(self.location):
+            for _, _, path in self._entries():
+                os.remove(path)
+
+        self.hits = 0
+        self.misses = 0
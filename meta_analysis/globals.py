@@ -1,5 +1,5 @@
 """Some globals variable used in other files."""
-from joblib import Memory
+from .cache import Cache
 
 cache_dir = 'cache_joblib'
-mem = Memory(cache_dir)
+cache = Cache(cache_dir)
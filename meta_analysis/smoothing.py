@@ -0,0 +1,572 @@
+"""Implement the gaussian smoothing engines of flattened maps."""
+import numpy as np
+import scipy.fftpack
+import scipy.sparse
+from scipy.ndimage import gaussian_filter1d
+from joblib import Parallel, delayed
+
+
+_kernels = dict()
+_spectra = dict()
+
+# FFT filtering is exact up to round-off errors of the order of 1e-16 times
+# the maximum of a map, which spread to the whole box. Values below FFT_RTOL
+# times the maximum of their map are set to 0 to keep the maps sparse.
+FFT_RTOL = 1e-12
+
+
+def gaussian_kernel1d(sigma, truncate=4.0):
+    """
+    Return the normalized 1D gaussian kernel of scipy.ndimage.gaussian_filter.
+
+    Kernels are cached per (sigma, truncate) and must not be modified. A
+    null sigma gives the identity kernel.
+
+    Args:
+        sigma (float): Standard deviation of the gaussian kernel in voxels.
+        truncate (float): The kernel is truncated at this many sigmas.
+
+    Returns:
+        (numpy.ndarray) 1D array of size 2*radius+1.
+
+    """
+    key = (float(sigma), float(truncate))
+
+    if key not in _kernels:
+        radius = int(truncate*float(sigma)+0.5)
+        x = np.arange(-radius, radius+1)
+        kernel = np.exp(-0.5/float(sigma)**2*x**2) if sigma else np.ones(1)
+        kernel /= kernel.sum()
+        kernel.flags.writeable = False
+        _kernels[key] = kernel
+
+    return _kernels[key]
+
+
+def gaussian_spectrum(n, sigma, truncate=4.0):
+    """
+    Return the spectrum of the gaussian kernel for FFT filtering along an axis.
+
+    Filtering in reflect mode is a circular convolution of the signal
+    extended by symmetry to a period 2n, which the type II DCT diagonalizes:
+    the spectrum is the real DFT of the kernel folded on this period, and
+    kernels wider than the axis need no padding. Spectra are cached per
+    (n, sigma, truncate) and must not be modified.
+
+    Args:
+        n (int): Size of the filtered axis.
+        sigma (float): Standard deviation of the gaussian kernel in voxels.
+        truncate (float): The kernel is truncated at this many sigmas.
+
+    Returns:
+        (numpy.ndarray) 1D array of size n.
+
+    """
+    key = (int(n), float(sigma), float(truncate))
+
+    if key not in _spectra:
+        kernel = gaussian_kernel1d(sigma, truncate)
+        radius = kernel.size//2
+        angles = np.pi/n*np.outer(np.arange(n), np.arange(1, radius+1))
+        spectrum = kernel[radius] + 2*np.cos(angles).dot(kernel[radius+1:])
+        spectrum.flags.writeable = False
+        _spectra[key] = spectrum
+
+    return _spectra[key]
+
+
+def largest_prime_factor(n):
+    """Return the largest prime factor of n (1 if n is 1)."""
+    factor, largest = 2, 1
+    while factor*factor <= n:
+        while n % factor == 0:
+            largest, n = factor, n//factor
+        factor += 1
+    return max(largest, n) if n > 1 else largest
+
+
+def use_fft(n, sigma, truncate=4.0):
+    """
+    Return whether FFT filtering along an axis of size n is cheaper than direct filtering.
+
+    Measured costs: direct filtering costs about kernel_size+22 units per
+    voxel whereas FFT filtering costs about 70 units per voxel, or 250
+    when n has a prime factor above 30 (Bluestein algorithm). On a 2mm MNI
+    box, FFT pays from sigma about 6 voxels on the axes of size 91.
+
+    """
+    size = gaussian_kernel1d(sigma, truncate).size
+    cost = 70 if largest_prime_factor(n) <= 30 else 250
+    return cost < size+22
+
+
+def fft_filter1d(block, axis, sigma, truncate=4.0):
+    """
+    Filter a block of maps along one axis with FFT in reflect mode.
+
+    All maps of the block are transformed at once with the type II DCT
+    (see gaussian_spectrum). The result equals
+    scipy.ndimage.gaussian_filter1d up to round-off errors.
+
+    Args:
+        block (numpy.ndarray): Array of maps, filtered in place.
+        axis (int): Filtered axis.
+        sigma (float): Standard deviation of the gaussian kernel in voxels.
+        truncate (float): The kernel is truncated at this many sigmas.
+
+    Returns:
+        (numpy.ndarray) The filtered block.
+
+    """
+    shape = [1]*block.ndim
+    shape[axis] = -1
+    spectrum = gaussian_spectrum(block.shape[axis], sigma, truncate).reshape(shape)
+
+    # The unnormalized type III DCT (idct of type 2) inverts the type II one up to 2n
+    transform = scipy.fftpack.dct(block, type=2, axis=axis)
+    transform *= spectrum/(2*block.shape[axis])
+    block[...] = scipy.fftpack.idct(transform, type=2, axis=axis, overwrite_x=True)
+
+    return block
+
+
+def filter_block(block, sigma, truncate=4.0, method='auto'):
+    """
+    Filter a block of maps with a gaussian kernel along its three first axes.
+
+    Each axis is filtered either directly or with FFT (see use_fft). The
+    result matches scipy.ndimage.gaussian_filter (mode reflect) exactly
+    with the direct method, and within FFT_RTOL times the maximum of each
+    map with the FFT one, values below being set to 0.
+
+    Args:
+        block (numpy.ndarray): Array of shape (Ni, Nj, Nk, B), filtered in
+            place.
+        sigma (float or sequence): Standard deviation of the gaussian kernel
+            in voxels, either one for all axes or one per axis. Axes of null
+            sigma are not filtered.
+        truncate (float): The kernel is truncated at this many sigmas.
+        method (str): 'direct', 'fft' or 'auto'.
+
+    Returns:
+        (numpy.ndarray) The filtered block.
+
+    """
+    if method not in ['auto', 'direct', 'fft']:
+        raise ValueError('Method must be \'auto\', \'direct\' or \'fft\'. Given {}.'.format(method))
+
+    fft_used = False
+    for axis, sigma_axis in enumerate(np.broadcast_to(np.asarray(sigma, dtype=float), 3)):
+        if not sigma_axis:
+            continue
+        if method == 'fft' or (method == 'auto' and use_fft(block.shape[axis], sigma_axis, truncate)):
+            fft_filter1d(block, axis, sigma_axis, truncate)
+            fft_used = True
+        else:
+            gaussian_filter1d(block, sigma_axis, axis=axis, output=block, truncate=truncate)
+
+    if fft_used:
+        magnitudes = np.abs(block)
+        block[magnitudes <= FFT_RTOL*magnitudes.max(axis=(0, 1, 2))] = 0
+
+    return block
+
+
+def reflect_indices(indices, n):
+    """Map indices out of [0, n) back into it as the reflect mode of scipy.ndimage does."""
+    indices = np.mod(indices, 2*n)
+    return np.where(indices >= n, 2*n-1-indices, indices)
+
+
+def use_stamping(nnz, shape, sigma, truncate=4.0):
+    """
+    Return for each map whether stamping is cheaper than filtering the dense box.
+
+    Measured costs: stamping costs about 38 units per kernel value, sorting
+    included, whereas densifying, filtering and sparsifying a map costs
+    about kernel_size+14 units per voxel of the box.
+
+    Args:
+        nnz (numpy.ndarray): Number of nonzero voxels of each map.
+        shape (tuple): Shape (Ni, Nj, Nk) of the box.
+
+    Returns:
+        (numpy.ndarray) 1D boolean array.
+
+    """
+    size = gaussian_kernel1d(sigma, truncate).size
+    return 38*np.asarray(nnz, dtype=np.int64)*size**3 < (size+14)*np.prod(shape)
+
+
+def stamp_smooth(maps, shape, sigma, truncate=4.0, max_entries=2**22):
+    """
+    Smooth sparse maps by summing a gaussian kernel at each nonzero voxel.
+
+    The filter being linear, the result equals scipy.ndimage.gaussian_filter
+    (mode reflect): parts of the kernel falling out of the box are clipped
+    and folded back into it. Columns are processed by groups holding at most
+    max_entries kernel values at once, whose duplicate positions are summed
+    after sorting them. Costs O(nnz*kernel_size**3) whatever the size of the
+    box instead of O(n_maps*n_voxels*kernel_size).
+
+    Args:
+        maps (scipy.sparse matrix): Matrix of shape (n_voxels, n_maps) of
+            maps flattened in Fortran order.
+        shape (tuple): Shape (Ni, Nj, Nk) of the box.
+        sigma (float): Standard deviation of the gaussian kernel in voxels.
+        truncate (float): The kernel is truncated at this many sigmas.
+        max_entries (int): Maximum number of values held at once.
+
+    Returns:
+        (scipy.sparse.csc_matrix) Smoothed maps of shape (n_voxels, n_maps).
+
+    """
+    Ni, Nj, Nk = shape
+    n_voxels, n_maps = maps.shape
+    maps = scipy.sparse.csc_matrix(maps)
+
+    kernel = gaussian_kernel1d(sigma, truncate)
+    radius = kernel.size//2
+    offsets = np.arange(-radius, radius+1)
+
+    # Groups of consecutive columns holding at most max_entries values
+    costs = np.concatenate([[0], np.cumsum(np.diff(maps.indptr).astype(np.int64)*kernel.size**3)])
+    bounds = [0]
+    while bounds[-1] < n_maps:
+        stop = np.searchsorted(costs, costs[bounds[-1]]+max_entries, side='right')-1
+        bounds.append(max(stop, bounds[-1]+1))
+
+    blocks = []
+    for start, stop in zip(bounds[:-1], bounds[1:]):
+        block = maps[:, start:stop].tocoo()
+        i, j, k = np.unravel_index(block.row, (Ni, Nj, Nk), order='F')
+
+        ii = reflect_indices(i[:, None]+offsets, Ni)
+        jj = reflect_indices(j[:, None]+offsets, Nj)
+        kk = reflect_indices(k[:, None]+offsets, Nk)
+
+        # Positions in the flattened (n_voxels, n_block_maps) block, column major
+        positions = (ii[:, :, None, None] + Ni*(jj[:, None, :, None] + Nj*kk[:, None, None, :])
+                     + n_voxels*block.col.astype(np.int64)[:, None, None, None]).ravel()
+        data = block.data.astype(np.float64)[:, None, None, None]*kernel[:, None, None]*kernel[None, :, None]*kernel[None, None, :]
+
+        # Overlapping kernels and folded borders are summed
+        order = np.argsort(positions)
+        positions, data = positions[order], data.ravel()[order]
+        firsts = np.flatnonzero(np.concatenate([[True], positions[1:] != positions[:-1]])) if positions.size else positions
+        values = np.add.reduceat(data, firsts) if positions.size else data
+        positions = positions[firsts]
+
+        nonzero = values != 0
+        positions, values = positions[nonzero], values[nonzero]
+        indptr = np.searchsorted(positions, n_voxels*np.arange(stop-start+1, dtype=np.int64))
+
+        blocks.append(scipy.sparse.csc_matrix((values, positions % n_voxels, indptr),
+                                              shape=(n_voxels, stop-start)))
+
+    if not blocks:
+        return scipy.sparse.csc_matrix((n_voxels, n_maps), dtype=np.float64)
+
+    return scipy.sparse.hstack(blocks, format='csc')
+
+
+def reflect_rows(n, sigma, truncate=4.0):
+    """
+    Return the nonzero entries of the rows of the 1D filtering matrix in reflect mode.
+
+    Row p holds the weights of the input voxels in output voxel p, parts
+    of the kernel falling out of the axis being folded back into it.
+
+    Args:
+        n (int): Size of the axis.
+        sigma (float): Standard deviation of the gaussian kernel in voxels.
+        truncate (float): The kernel is truncated at this many sigmas.
+
+    Returns:
+        (tuple) Arrays of shape (n, width) of the sorted columns and the
+            weights of the rows, padded with null weights.
+
+    """
+    kernel = gaussian_kernel1d(sigma, truncate)
+    radius = kernel.size//2
+    outputs = np.arange(n)
+
+    matrix = np.zeros((n, n))
+    inputs = reflect_indices(outputs[:, None]+np.arange(-radius, radius+1)[None, :], n)
+    np.add.at(matrix, (np.broadcast_to(outputs[:, None], inputs.shape), inputs), kernel[None, :])
+
+    width = max(1, int((matrix != 0).sum(axis=1).max()))
+    columns = np.argsort(matrix == 0, axis=1, kind='stable')[:, :width]
+    columns.sort(axis=1)
+
+    return columns, np.take_along_axis(matrix, columns, axis=1)
+
+
+def smoothing_operator(shape, sigma, truncate=4.0, voxel_ids=None, max_entries=2**22):
+    """
+    Build the sparse matrix S such that S @ maps smooths the flattened maps.
+
+    The operator equals scipy.ndimage.gaussian_filter (mode reflect) with
+    the kernel truncated at truncate sigmas, restricted to the given voxels:
+    only maps nonzero on them are smoothed exactly and the values smoothed
+    out of them are dropped. It holds at most
+    len(voxel_ids)*(2*int(truncate*sigma+0.5)+1)**3 values (12 bytes each),
+    built by groups of rows of at most max_entries values.
+
+    Args:
+        shape (tuple): Shape (Ni, Nj, Nk) of the box.
+        sigma (float or sequence): Standard deviation of the gaussian kernel
+            in voxels, one per axis if a sequence.
+        truncate (float): The kernel is truncated at this many sigmas.
+        voxel_ids (numpy.ndarray): Sorted flat ids (Fortran order) of the
+            voxels of the mask. If None, the whole box.
+        max_entries (int): Maximum number of values built at once.
+
+    Returns:
+        (scipy.sparse.csr_matrix) Operator of shape (n_voxels, n_voxels).
+
+    """
+    Ni, Nj, Nk = shape
+    n_voxels = Ni*Nj*Nk
+    voxel_ids = np.arange(n_voxels) if voxel_ids is None else np.asarray(voxel_ids, dtype=np.int64)
+    inside = np.zeros(n_voxels, dtype=bool)
+    inside[voxel_ids] = True
+
+    sigmas = np.broadcast_to(np.asarray(sigma, dtype=float), 3)
+    (ci, wi), (cj, wj), (ck, wk) = [reflect_rows(n, s, truncate) for n, s in zip(shape, sigmas)]
+    size = ci.shape[1]*cj.shape[1]*ck.shape[1]
+    step = max(1, max_entries//size)
+
+    # Rows are filled in place in buffers trimmed at the end
+    index_dtype = np.int32 if n_voxels < 2**31 else np.int64
+    data = np.empty(len(voxel_ids)*size)
+    indices = np.empty(len(voxel_ids)*size, dtype=index_dtype)
+    row_counts = np.zeros(n_voxels, dtype=np.int64)
+
+    nnz = 0
+    for start in range(0, len(voxel_ids), step):
+        i, j, k = np.unravel_index(voxel_ids[start:start+step], shape, order='F')
+
+        # Rows of the 3D operator are outer products of the 1D ones, ordered
+        # so that their columns are sorted
+        positions = ci[i, None, None, :] + Ni*(cj[j, None, :, None] + Nj*ck[k, :, None, None])
+        values = wi[i, None, None, :]*wj[j, None, :, None]*wk[k, :, None, None]
+
+        keep = (values != 0) & inside[positions]
+        count = np.count_nonzero(keep)
+        data[nnz:nnz+count] = values[keep]
+        indices[nnz:nnz+count] = positions[keep]
+        row_counts[voxel_ids[start:start+step]] = keep.reshape(len(i), -1).sum(axis=1)
+        nnz += count
+
+    indptr = np.concatenate([[0], np.cumsum(row_counts)]).astype(index_dtype)
+
+    return scipy.sparse.csr_matrix((data[:nnz], indices[:nnz], indptr), shape=(n_voxels, n_voxels))
+
+
+def apply_operator(operator, maps, n_jobs=1):
+    """
+    Compute operator @ maps in one sparse product split by rows among threads.
+
+    Args:
+        operator (scipy.sparse.csr_matrix): Operator of shape (n_voxels,
+            n_voxels), see smoothing_operator.
+        maps (scipy.sparse matrix or numpy.ndarray): Matrix of shape
+            (n_voxels, n_maps).
+        n_jobs (int): Number of threads.
+
+    Returns:
+        (scipy.sparse.csr_matrix or numpy.ndarray) Matrix of shape
+            (n_voxels, n_maps), dense if maps is.
+
+    """
+    dense = isinstance(maps, np.ndarray)
+    maps = maps if dense else scipy.sparse.csr_matrix(maps)
+    n_jobs = max(1, n_jobs)
+
+    # Bounds of row blocks holding about the same number of operator values
+    bounds = np.searchsorted(operator.indptr, np.linspace(0, operator.nnz, n_jobs+1), side='left')
+    bounds[0], bounds[-1] = 0, operator.shape[0]
+    bounds = np.unique(bounds)
+
+    products = Parallel(n_jobs=n_jobs, backend='threading')(
+        delayed(operator[start:stop].dot)(maps) for start, stop in zip(bounds[:-1], bounds[1:]))
+
+    if dense:
+        return np.vstack(products)
+
+    if len(products) == 1:
+        return scipy.sparse.csr_matrix(products[0])
+
+    return scipy.sparse.vstack(products, format='csr')
+
+
+def batch_size(shape, max_bytes=2**27):
+    """Return the number of float64 maps of the given box shape fitting in max_bytes (at least 1)."""
+    return max(1, int(max_bytes//(8*int(np.prod(shape)))))
+
+
+def smooth_block(maps, shape, sigma, buffer):
+    """
+    Smooth a block of maps at once in a preallocated buffer.
+
+    The maps are written in the buffer which is filtered at once along the
+    three spatial axes (see filter_block), so that there is no per-map
+    allocation.
+
+    Args:
+        maps (scipy.sparse matrix or numpy.ndarray): Sparse matrix of shape
+            (n_voxels, B) of maps flattened in Fortran order, or 4D array of
+            shape (Ni, Nj, Nk, B).
+        shape (tuple): Shape (Ni, Nj, Nk) of the box.
+        sigma (float or sequence): Standard deviation of the gaussian kernel
+            in voxels, one per axis if a sequence (see filter_block). If None
+            or 0, maps are only copied.
+        buffer (numpy.ndarray): Fortran ordered float64 array of shape
+            (Ni, Nj, Nk, B_max) with B_max >= B.
+
+    Returns:
+        (numpy.ndarray) Fortran ordered view of the buffer of shape
+            (n_voxels, B) holding the smoothed maps.
+
+    """
+    n_maps = maps.shape[-1]
+    block = buffer[..., :n_maps]
+
+    if isinstance(maps, np.ndarray):
+        block[...] = maps
+
+    else:
+        maps = scipy.sparse.csc_matrix(maps)
+        maps.sum_duplicates()
+        block.fill(0)
+        flat = block.reshape(-1, order='F')
+        cols = np.repeat(np.arange(n_maps), np.diff(maps.indptr))
+        flat[maps.indices + flat.size//n_maps*cols] = maps.data
+
+    if sigma is not None and np.any(sigma):
+        filter_block(block, sigma)
+
+    return block.reshape((-1, n_maps), order='F')
+
+
+def negligible(array, rtol=0., atol=0.):
+    """Return the mask of the values v of the columns of a 2D array of maximum absolute value m with |v| <= max(atol, rtol*m)."""
+    magnitudes = np.abs(array)
+    return magnitudes <= np.maximum(atol, rtol*magnitudes.max(axis=0))
+
+
+def dense_to_csc(array, rtol=0., atol=0.):
+    """
+    Convert a Fortran ordered 2D array into a CSC matrix without intermediate copies.
+
+    Values v of a column of maximum absolute value m are dropped when
+    |v| <= max(atol, rtol*m), see sparsify.
+    """
+    n_rows, n_cols = array.shape
+    flat = array.reshape(-1, order='F')
+
+    if (rtol or atol) and array.size:
+        kept = ~negligible(array, rtol=rtol, atol=atol)
+        positions = np.flatnonzero(kept.reshape(-1, order='F'))
+    else:
+        positions = np.flatnonzero(flat)
+
+    indptr = np.searchsorted(positions, n_rows*np.arange(n_cols+1))
+
+    return scipy.sparse.csc_matrix((flat[positions], positions % n_rows, indptr), shape=array.shape)
+
+
+def sparsify(maps, rtol=0., atol=0.):
+    """
+    Drop the negligible values of sparse maps.
+
+    Values v of a map of maximum absolute value m are dropped when
+    |v| <= max(atol, rtol*m), so that smoothed maps only store the support
+    of the signal.
+
+    Args:
+        maps (scipy.sparse matrix): Matrix of shape (n_voxels, n_maps).
+        rtol (float): Tolerance relative to the maximum of each map.
+        atol (float): Absolute tolerance.
+
+    Returns:
+        (scipy.sparse.csc_matrix) Maps of shape (n_voxels, n_maps).
+
+    """
+    maps = scipy.sparse.csc_matrix(maps)
+
+    if not rtol and not atol:
+        return maps
+
+    magnitudes = np.abs(maps.data)
+    cols = np.repeat(np.arange(maps.shape[1]), np.diff(maps.indptr))
+    maxima = np.zeros(maps.shape[1])
+    np.maximum.at(maxima, cols, magnitudes)
+
+    kept = magnitudes > np.maximum(atol, rtol*maxima)[cols]
+    indptr = np.concatenate([[0], np.cumsum(kept)])[maps.indptr]
+
+    return scipy.sparse.csc_matrix((maps.data[kept], maps.indices[kept], indptr), shape=maps.shape)
+
+
+def dense_smooth(maps, shape, sigma, max_bytes=2**27, n_jobs=1, rtol=0., atol=0., dense=False):
+    """
+    Smooth maps by blocks filtered at once (see smooth_block).
+
+    The block size is chosen so that the buffers of the n_jobs threads hold
+    at most max_bytes. Negligible values are dropped from each block before
+    it is converted to a sparse matrix (see sparsify). With dense, blocks
+    are filtered in place in the returned array and negligible values are
+    set to 0.
+
+    Args:
+        maps (scipy.sparse matrix or numpy.ndarray): Sparse matrix of shape
+            (n_voxels, n_maps) of maps flattened in Fortran order, or 4D
+            array of shape (Ni, Nj, Nk, n_maps).
+        shape (tuple): Shape (Ni, Nj, Nk) of the box.
+        sigma (float or sequence): Standard deviation of the gaussian kernel
+            in voxels, one per axis if a sequence.
+        max_bytes (int): Memory budget of the buffers.
+        n_jobs (int): Number of threads.
+        rtol (float): Tolerance relative to the maximum of each map.
+        atol (float): Absolute tolerance.
+        dense (bool): If True, return a numpy array instead of a sparse
+            matrix.
+
+    Returns:
+        (scipy.sparse.csc_matrix or numpy.ndarray) Smoothed maps of shape
+            (n_voxels, n_maps), Fortran ordered if dense.
+
+    """
+    n_maps = maps.shape[-1]
+    n_jobs = max(1, min(n_jobs, n_maps))
+    size = min(batch_size(shape, max_bytes//n_jobs), -(-n_maps//n_jobs)) if n_maps else 1
+    bounds = list(range(0, n_maps, size)) + [n_maps]
+    array = np.zeros(tuple(shape)+(n_maps,), order='F') if dense else None
+
+    def smooth_blocks(blocks):
+        if dense:
+            for start, stop in blocks:
+                block = smooth_block(maps[..., start:stop], shape, sigma, array[..., start:stop])
+                if (rtol or atol) and block.size:
+                    block[negligible(block, rtol=rtol, atol=atol)] = 0
+            return []
+
+        buffer = np.zeros(tuple(shape)+(size,), order='F')
+        return [dense_to_csc(smooth_block(maps[..., start:stop], shape, sigma, buffer), rtol=rtol, atol=atol)
+                for start, stop in blocks]
+
+    blocks = list(zip(bounds[:-1], bounds[1:]))
+    results = Parallel(n_jobs=n_jobs, backend='threading')(delayed(smooth_blocks)(blocks[k::n_jobs]) for k in range(n_jobs))
+
+    if dense:
+        return array.reshape((-1, n_maps), order='F')
+
+    # Blocks were dealt to the threads in turn
+    csc_matrices = [results[k % n_jobs][k//n_jobs] for k in range(len(blocks))]
+
+    if not csc_matrices:
+        return scipy.sparse.csc_matrix((int(np.prod(shape)), 0), dtype=np.float64)
+
+    return scipy.sparse.hstack(csc_matrices, format='csc')
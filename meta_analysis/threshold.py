@@ -4,7 +4,7 @@ from joblib import Parallel, delayed
 from time import time
 import numpy as np
 
-from .globals import mem
+from .globals import cache
 from .tools import print_percent
 from .Maps import Maps
 
@@ -42,7 +42,7 @@ def threshold_MC_pool(N_sim, kwargs):
     return avgs, vars, covs
 
 
-@mem.cache
+@cache.cache(ignore=['verbose'])
 def threshold_MC(n_peaks, n_maps, Ni, Nj, Nk, stats=['avg', 'var'], N_sim=5000,
                  sigma=1., verbose=False, p=None, mask=None):
     """
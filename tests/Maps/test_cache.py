@@ -0,0 +1,117 @@
+"""Test the cache of meta_analysis."""
+import tempfile
+import unittest
+import numpy as np
+import pandas as pd
+
+from meta_analysis.cache import Cache, fingerprint
+
+
+class FingerprintTestCase(unittest.TestCase):
+    """Test fingerprint function."""
+
+    def test_dataframe(self):
+        """Test equal and different dataframes."""
+        df = pd.DataFrame({'x': [1., 2.], 'y': [3., 4.]})
+        df2 = df.copy()
+        df2.loc[0, 'x'] = 0.
+
+        self.assertEqual(fingerprint(df), fingerprint(df.copy()))
+        self.assertNotEqual(fingerprint(df), fingerprint(df2))
+
+    def test_array(self):
+        """Test arrays with same data and different shapes."""
+        array = np.arange(6)
+
+        self.assertEqual(fingerprint(array), fingerprint(np.arange(6)))
+        self.assertNotEqual(fingerprint(array), fingerprint(array.reshape((2, 3))))
+
+    def test_inplace(self):
+        """Test that inplace modifications change the fingerprint of writeable objects only."""
+        df = pd.DataFrame({'x': [1., 2.], 'y': [3., 4.]})
+        array = np.arange(6.)
+        fp_df, fp_array = fingerprint(df), fingerprint(array)
+        df.loc[0, 'x'] = 5.
+        array[0] = 5.
+
+        self.assertNotEqual(fingerprint(df), fp_df)
+        self.assertNotEqual(fingerprint(array), fp_array)
+
+        array.flags.writeable = False
+        self.assertTrue(fingerprint(array) is fingerprint(array))
+
+
+class CacheTestCase(unittest.TestCase):
+    """Test Cache class."""
+
+    def setUp(self):
+        """Set up a cache in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.cache = Cache(self.tmpdir.name)
+        self.calls = 0
+
+        @self.cache.cache(ignore=['verbose'])
+        def f(array, verbose=False):
+            self.calls += 1
+            return 2*array
+
+        self.f = f
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.tmpdir.cleanup()
+
+    def test_hit(self):
+        """Test that a second call is a hit."""
+        array = np.arange(10)
+        self.f(array)
+        res = self.f(array, verbose=True)
+
+        self.assertTrue(np.array_equal(res, 2*array))
+        self.assertEqual(self.calls, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_miss(self):
+        """Test that different arguments are misses."""
+        self.f(np.arange(10))
+        self.f(np.arange(11))
+
+        self.assertEqual(self.calls, 2)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_inplace_miss(self):
+        """Test that a dataframe modified inplace is a miss."""
+        df = pd.DataFrame({'x': [1., 2.], 'y': [3., 4.]})
+        self.f(df)
+        df.loc[0, 'x'] = 5.
+        res = self.f(df)
+
+        self.assertEqual(res.loc[0, 'x'], 10.)
+        self.assertEqual((self.cache.hits, self.cache.misses), (0, 2))
+
+    def test_no_location(self):
+        """Test that nothing is cached without location."""
+        self.cache.location = None
+        self.f(np.arange(10))
+        self.f(np.arange(10))
+
+        self.assertEqual(self.calls, 2)
+
+    def test_eviction(self):
+        """Test that the least recently used result is evicted."""
+        self.f(np.arange(1000))
+        self.cache.bytes_limit = 1.5*self.cache.size()
+        self.f(np.arange(1001))
+
+        self.assertLessEqual(self.cache.size(), self.cache.bytes_limit)
+        self.f(np.arange(1001))
+        self.f(np.arange(1000))
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 3))
+
+    def test_clear(self):
+        """Test clearing the cache."""
+        self.f(np.arange(10))
+        self.cache.clear()
+
+        self.assertEqual(self.cache.size(), 0)
+        self.assertEqual(self.cache.misses, 0)
@@ -1,9 +1,15 @@
 """Test the classmethods of Maps."""
+import os
+import tempfile
 import unittest
 import numpy as np
+import nibabel as nib
+import scipy.sparse
 
 from meta_analysis import Maps
-from globals_test import template, Ni, Nj, Nk, affine
+from meta_analysis.blocks import BlockMatrix
+from globals_test import template, Ni, Nj, Nk, affine, df_ex, groupby_col, \
+    gray_mask, atlas
 
 
 class EmptyTestCase(unittest.TestCase):
@@ -154,6 +160,221 @@ class RandomTestCase(unittest.TestCase):
         self.assertTrue(np.array_equal(maps1.to_array(), maps2.to_array()))
 
 
+class FromCoordinateChunksTestCase(unittest.TestCase):
+    """Test Maps.from_coordinate_chunks classmethod."""
+
+    def setUp(self):
+        """Set up the maps built from the whole dataframe."""
+        self.expected = Maps(df_ex, template=template, groupby_col=groupby_col)
+
+    def test_no_groupby(self):
+        """Test without groupby column."""
+        with self.assertRaises(TypeError):
+            Maps.from_coordinate_chunks([df_ex], template=template)
+
+    def test_chunks(self):
+        """Test from an iterable of dataframes."""
+        chunks = (df_ex.iloc[k:k+1] for k in range(df_ex.shape[0]))
+        maps = Maps.from_coordinate_chunks(chunks, template=template,
+                                           groupby_col=groupby_col)
+
+        self.assertEqual(maps.map_ids, ['mymap', 'mymap2'])
+        self.assertTrue(np.array_equal(maps.to_array(),
+                                       self.expected.to_array()))
+
+    def test_csv(self):
+        """Test from a csv file."""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'coordinates.csv')
+            df_ex.to_csv(path, index=False)
+            maps = Maps.from_coordinate_chunks(path, template=template,
+                                               groupby_col=groupby_col,
+                                               chunksize=2)
+
+        self.assertEqual(maps.map_ids, ['mymap', 'mymap2'])
+        self.assertTrue(np.array_equal(maps.to_array(),
+                                       self.expected.to_array()))
+
+
+class FromFilesTestCase(unittest.TestCase):
+    """Test Maps.from_files classmethod."""
+
+    def setUp(self):
+        """Save some images in a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.array = np.random.rand(3, 4, 5, 3)
+        self.paths = []
+        for k in range(3):
+            path = os.path.join(self.tmpdir.name, f'{k}.nii.gz')
+            nib.save(nib.Nifti1Image(self.array[:, :, :, k], affine), path)
+            self.paths.append(path)
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.tmpdir.cleanup()
+
+    def test_empty(self):
+        """Test empty sequence."""
+        with self.assertRaises(ValueError):
+            Maps.from_files([])
+
+    def test_order(self):
+        """Test maps are stored in the order of the files."""
+        maps = Maps.from_files(self.paths, n_jobs=2)
+        self.assertEqual(maps.n_m, 3)
+        self.assertTrue(np.allclose(maps.to_array(), self.array))
+        self.assertTrue(np.array_equal(maps.affine, affine))
+
+    def test_affine_missmatch(self):
+        """Test file with a different affine."""
+        path = os.path.join(self.tmpdir.name, 'missmatch.nii.gz')
+        nib.save(nib.Nifti1Image(self.array[:, :, :, 0], 2*affine), path)
+        with self.assertRaises(ValueError):
+            Maps.from_files(self.paths+[path])
+
+    def test_box_missmatch(self):
+        """Test file with a different box size."""
+        path = os.path.join(self.tmpdir.name, 'missmatch.nii.gz')
+        nib.save(nib.Nifti1Image(self.array[1:, :, :, 0], affine), path)
+        with self.assertRaises(ValueError):
+            Maps.from_files(self.paths+[path])
+
+
+class SaveLoadTestCase(unittest.TestCase):
+    """Test Maps.save and Maps.load."""
+
+    def setUp(self):
+        """Set up a temporary directory."""
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'maps')
+
+    def tearDown(self):
+        """Remove the temporary directory."""
+        self.tmpdir.cleanup()
+
+    def check_equal(self, maps1, maps2):
+        """Check the maps and header are equal."""
+        self.assertEqual(maps1.shape, maps2.shape)
+        self.assertTrue(np.array_equal(maps1.affine, maps2.affine))
+        self.assertEqual(maps1.map_ids, maps2.map_ids)
+        self.assertEqual(maps1._has_mask(), maps2._has_mask())
+        self.assertEqual(maps1._has_atlas(), maps2._has_atlas())
+        self.assertEqual((maps1.maps != maps2.maps).nnz, 0)
+
+    def test_mmap(self):
+        """Test memory-mapped reopen."""
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col,
+                    mask=gray_mask, atlas=atlas)
+        maps.save(self.path)
+        maps2 = Maps.load(self.path)
+
+        self.check_equal(maps, maps2)
+        self.assertEqual((maps._maps_atlas != maps2._maps_atlas).nnz, 0)
+
+    def test_no_mmap(self):
+        """Test reopen in memory."""
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        maps.save(self.path)
+
+        self.check_equal(maps, Maps.load(self.path, mmap=False))
+
+    def test_empty(self):
+        """Test empty maps."""
+        maps = Maps.empty(template=template)
+        maps.save(self.path)
+
+        self.assertTrue(Maps.load(self.path).maps is None)
+
+    def test_blocks(self):
+        """Test out-of-core reopen of maps saved by blocks."""
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col,
+                    atlas=atlas)
+        maps.save(self.path, block_size=1)
+        maps2 = Maps.load(self.path)
+
+        self.assertTrue(isinstance(maps2.maps, BlockMatrix))
+        self.assertEqual(maps2.shape, maps.shape)
+        self.assertTrue(np.allclose(maps2.maps.toarray(), maps.maps.toarray()))
+        self.assertTrue(np.allclose(maps2.sum(axis=0), maps.sum(axis=0)))
+        self.assertTrue(np.allclose(maps2.max(axis=1), maps.max(axis=1)))
+        self.assertTrue(np.allclose(maps2.avg().maps.toarray(), maps.avg().maps.toarray()))
+        self.assertTrue(np.allclose(maps2.var().maps.toarray(), maps.var().maps.toarray()))
+        self.assertTrue(np.allclose(maps2.normalize().maps.toarray(), maps.normalize().maps.toarray()))
+        self.assertTrue(np.allclose(maps2.smooth(sigma=2).maps.toarray(), maps.smooth(sigma=2).maps.toarray()))
+        self.assertTrue(np.allclose(maps2.to_img().get_fdata(), maps.to_img().get_fdata()))
+
+    def test_blocks_operations(self):
+        """Test out-of-core operators, threshold and split, and that shuffle is rejected."""
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        maps.save(self.path, block_size=1)
+        maps2 = Maps.load(self.path)
+
+        for result, expected in [(maps2 + maps, maps + maps), (maps + maps2, maps + maps), (maps2 + maps2, maps + maps),
+                                 (maps2 * 2, maps * 2),
+                                 (maps2.threshold(2), maps.threshold(2))]:
+            self.assertTrue(isinstance(result.maps, BlockMatrix))
+            self.assertTrue(np.allclose(result.maps.toarray(), expected.maps.toarray()))
+            self.assertFalse(result.maps.path.startswith(self.tmpdir.name))
+
+        for result, expected in zip(maps2.split(prop=0.5, random_state=0), maps.split(prop=0.5, random_state=0)):
+            self.assertTrue(isinstance(result.maps, BlockMatrix))
+            self.assertTrue(np.allclose(result.maps.toarray(), expected.maps.toarray()))
+
+        with self.assertRaises(ValueError):
+            maps2.shuffle(random_state=0)
+
+    def test_dense_blocks(self):
+        """Test that blocks are stored densely when sparsity would not pay off."""
+        dense, sparse = np.arange(8.).reshape(4, 2), scipy.sparse.eye(4, 3, format='csr')
+        blocks = BlockMatrix.from_blocks([dense, sparse], path=self.path)
+        self.assertEqual(blocks.dense, [True, False])
+        self.assertTrue(np.array_equal(BlockMatrix(self.path).toarray(), np.hstack([dense, sparse.toarray()])))
+
+    def test_dense_blocks_operations(self):
+        """Test that dense blocks are read as arrays and mixed with sparse ones, on disk and in memory."""
+        dense, sparse = np.arange(8.).reshape(4, 2), scipy.sparse.eye(4, 3, format='csr')
+        expected = np.hstack([dense, sparse.toarray()])
+        other = scipy.sparse.random(5, 2, density=0.5, format='csr', random_state=0)
+        for blocks in [BlockMatrix.from_blocks([dense, sparse], path=self.path),
+                       BlockMatrix.from_blocks([dense, sparse], in_memory=True)]:
+            self.assertTrue(isinstance(blocks.block(0), np.ndarray))
+            self.assertTrue(scipy.sparse.issparse(blocks.block(1)))
+            self.assertTrue(np.allclose(blocks.sum(axis=0), expected.sum(axis=0, keepdims=True)))
+            self.assertTrue(np.allclose(blocks.sum(axis=1), expected.sum(axis=1, keepdims=True)))
+            self.assertTrue(np.allclose(blocks.max(axis=0), expected.max(axis=0, keepdims=True)))
+            self.assertTrue(np.allclose(blocks.max(axis=1), expected.max(axis=1, keepdims=True)))
+            self.assertTrue(np.allclose(blocks.dot(other).toarray(), expected.dot(other.toarray())))
+            self.assertTrue(np.allclose(blocks[:, [1, 3]].toarray(), expected[:, [1, 3]]))
+            self.assertEqual(blocks.count_nonzero(), np.count_nonzero(expected))
+            self.assertEqual(blocks.map_blocks(lambda block, cols: 2*block).in_memory, blocks.in_memory)
+
+    def test_smooth_blocks(self):
+        """Test smoothing in out-of-core blocks with a truncation tolerance."""
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        smoothed = maps.smooth(sigma=2, rtol=1e-3)
+        blocks = maps.smooth(sigma=2, rtol=1e-3, block_size=1)
+
+        self.assertTrue(isinstance(blocks.maps, BlockMatrix))
+        self.assertTrue(np.allclose(blocks.maps.toarray(), smoothed.maps.toarray()))
+        self.assertTrue(smoothed.maps.nnz < maps.smooth(sigma=2).maps.nnz)
+
+    def test_smooth_in_memory(self):
+        """Test smoothing in blocks held in memory."""
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        smoothed = maps.smooth(sigma=2)
+        for block_size in [None, 1]:
+            blocks = maps.smooth(sigma=2, block_size=block_size, in_memory=True)
+            self.assertTrue(blocks.maps.in_memory)
+            self.assertTrue(np.allclose(blocks.maps.toarray(), smoothed.maps.toarray()))
+            self.assertTrue(np.allclose(blocks.smooth(sigma=1).maps.toarray(), smoothed.smooth(sigma=1).maps.toarray()))
+
+    def test_smooth_zero(self):
+        """Test that maps are unchanged with a null sigma."""
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        self.assertTrue(np.allclose(maps.smooth(sigma=0).maps.toarray(), maps.maps.toarray()))
+        self.assertTrue(np.allclose(maps.smooth(sigma=0, map_id=1).maps.toarray(), maps.maps[:, 1].toarray()))
+
+
 class CopyHeaderTestCase(unittest.TestCase):
     """Test Maps.copy_header classmethod."""
 
@@ -1,6 +1,7 @@
 import unittest
 from hypothesis import given
 import numpy as np
+import nibabel as nib
 import scipy
 
 from meta_analysis import Maps
@@ -131,3 +132,41 @@ class ToImgTestCase(unittest.TestCase):
         maps = Maps(self.array4D_2)
         with self.assertRaises(ValueError):
             maps.to_img()
+
+
+class ToArrayAtlasTestCase(unittest.TestCase):
+    def setUp(self):
+        self.labels = np.random.randint(0, 3, size=(3, 3, 3)).astype(np.int16)
+        self.atlas = {
+            'maps': nib.Nifti1Image(self.labels, np.eye(4)),
+            'labels': ['Background', 'A', 'B']
+        }
+        self.maps = Maps(np.random.rand(3, 3, 3, 2), affine=np.eye(4), atlas=self.atlas)
+
+    def expected(self, map_id, ignore_bg):
+        array = np.zeros((3, 3, 3))
+        for k in range(1 if ignore_bg else 0, 3):
+            array[self.labels == k] = self.maps._maps_atlas[k, map_id]
+        return array
+
+    def test_all(self):
+        array = self.maps.to_array_atlas(ignore_bg=False)
+        self.assertEqual(array.shape, (3, 3, 3, 2))
+        for k in range(2):
+            self.assertTrue(np.array_equal(array[:, :, :, k], self.expected(k, False)))
+
+    def test_one_ignore_bg(self):
+        self.assertTrue(np.array_equal(self.maps.to_array_atlas(1, ignore_bg=True), self.expected(1, True)))
+
+
+class ToAtlasTestCase(unittest.TestCase):
+    def setUp(self):
+        self.array = np.round(4*np.random.rand(4, 4, 4, 5)-2)
+
+    def test_argmax(self):
+        atlas = Maps(self.array, affine=np.eye(4)).to_atlas()
+        expected = np.argmax(np.concatenate((np.zeros((4, 4, 4, 1)), self.array), axis=3), axis=3)
+
+        self.assertEqual(atlas['maps'].get_data_dtype(), np.uint8)
+        self.assertTrue(np.array_equal(np.asarray(atlas['maps'].dataobj), expected))
+        self.assertEqual(len(atlas['labels']), 5)
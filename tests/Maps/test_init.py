@@ -1,10 +1,16 @@
+import os
+import tempfile
 import unittest
 from hypothesis import given, settings
 import hypothesis.strategies as strats
 import numpy as np
+import nibabel as nib
+import nilearn.image
 import scipy
+from scipy.ndimage import gaussian_filter
 
 from meta_analysis import Maps
+from meta_analysis.Maps import build_maps_from_img
 from globals_test import gray_mask, template, atlas, df_ex, Ni, Nj, Nk, \
  groupby_col, affine, array2D, array3D, array4D_1, array4D_2, \
  example_maps, array2D_missmatch, array3D_missmatch, array4D_1_missmatch, \
@@ -17,6 +23,17 @@ class DataFrameInitTestCase(unittest.TestCase):
         self.assertFalse(maps._has_mask())
         self.assertFalse(maps._has_atlas())
 
+    def test_duplicate_peaks(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        self.assertTrue(np.array_equal(maps.n_peaks(), [2, 1]))
+        self.assertEqual(maps.maps.nnz, 2)
+
+    def test_n_jobs(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        maps2 = Maps(df_ex, template=template, groupby_col=groupby_col, n_jobs=2)
+        self.assertTrue(np.array_equal(maps.to_array(), maps2.to_array()))
+        self.assertEqual(maps.map_ids, maps2.map_ids)
+
     def test_allowed_template_mask(self):
         maps = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask)
         self.assertTrue(maps._has_mask())
@@ -254,6 +271,19 @@ class ImgInitTestCase(unittest.TestCase):
     def test_allowed(self):
         maps = Maps(fmri_img)
 
+    def test_slabs(self):
+        img = nib.Nifti1Image(array4D_2, affine)
+        maps = build_maps_from_img(img, dtype=np.float64, max_bytes=1)[0]
+        self.assertTrue(np.allclose(maps.toarray(), Maps.flatten_array(array4D_2, _2D=2)))
+        self.assertTrue(np.allclose(Maps(img).to_array(), array4D_2))
+
+    def test_gz_slabs(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'img.nii.gz')
+            nib.save(nib.Nifti1Image(array4D_2, affine), path)
+            maps = build_maps_from_img(path, dtype=np.float64, max_bytes=1)[0]
+        self.assertTrue(np.allclose(maps.toarray(), Maps.flatten_array(array4D_2, _2D=2)))
+
     def test_allowed_atlas(self):
         maps = Maps(fmri_img, atlas=atlas_2)
 
@@ -267,3 +297,110 @@ class ImgInitTestCase(unittest.TestCase):
     def test_mask_missmatch(self):
         with self.assertRaises(ValueError):
             maps = Maps(fmri_img, mask=gray_mask)
+
+
+class CompactInitTestCase(unittest.TestCase):
+    def test_compact(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask, atlas=atlas)
+        compact = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask, atlas=atlas, compact=True)
+        self.assertEqual(compact._maps.shape[0], np.sum(gray_mask.get_fdata() != 0))
+        self.assertEqual(compact.shape, maps.shape)
+        self.assertEqual((compact.maps != maps.maps).nnz, 0)
+        self.assertTrue(np.allclose(compact.to_array(), maps.to_array()))
+        self.assertTrue(np.allclose(compact.sum(axis=1), maps.sum(axis=1)))
+        self.assertTrue(np.allclose(compact.avg().maps.toarray(), maps.avg().maps.toarray()))
+        self.assertTrue(np.allclose(compact._maps_atlas.toarray(), maps._maps_atlas.toarray()))
+
+    def test_compact_smooth(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask)
+        compact = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask, compact=True)
+        self.assertTrue(np.allclose(compact.smooth(sigma=1).to_array(), maps.smooth(sigma=1).to_array()))
+
+    def test_operator_smooth(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask)
+        compact = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask, compact=True)
+        smoothed = compact.smooth(sigma=1, operator=True, truncate=1.)
+        expected = gaussian_filter(maps.to_array(), sigma=(1, 1, 1, 0), truncate=1.)*(gray_mask.get_fdata() != 0)[..., None]
+        self.assertTrue(compact._is_compact(smoothed._maps))
+        self.assertTrue(np.allclose(smoothed.to_array(), expected))
+        self.assertTrue(np.allclose(maps.smooth(sigma=1, operator=True, truncate=1.).to_array(), expected))
+
+
+class CountDtypeInitTestCase(unittest.TestCase):
+    def test_count(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        counts = Maps(df_ex, template=template, groupby_col=groupby_col, dtype=np.uint8)
+        self.assertEqual(counts.maps.dtype, np.uint8)
+        self.assertTrue(np.allclose(counts.to_array(), maps.to_array()))
+        self.assertTrue(np.allclose(counts.avg().to_array(), maps.avg().to_array()))
+        self.assertEqual(counts.avg().maps.dtype, np.float64)
+        self.assertEqual(counts.var().maps.dtype, np.float64)
+        self.assertEqual(counts.smooth(sigma=1).maps.dtype, np.float64)
+        self.assertEqual((counts*2).maps.dtype, np.uint8)
+        self.assertEqual((counts*0.5).maps.dtype, np.float64)
+        self.assertEqual(counts.normalize().maps.dtype, np.float64)
+        self.assertTrue(np.allclose(counts.normalize().to_array(), maps.normalize().to_array()))
+
+    def test_overflow(self):
+        maps = Maps(np.full((2, 2, 2), 200.), affine=affine, dtype=np.uint8)
+        self.assertEqual(maps.maps.dtype, np.uint8)
+        maps = maps + maps
+        self.assertEqual(maps.maps.dtype, np.uint16)
+        self.assertTrue(np.all(maps.to_array() == 400))
+
+    def test_non_counts(self):
+        with self.assertRaises(ValueError):
+            Maps(np.full((2, 2, 2), 0.5), affine=affine, dtype=np.uint8)
+
+
+class AtlasSpaceInitTestCase(unittest.TestCase):
+    def test_atlas_space(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask, atlas=atlas)
+        atlas_maps = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask, atlas=atlas, space='atlas')
+        self.assertIsNone(atlas_maps._maps)
+        self.assertEqual(atlas_maps.n_m, maps.n_m)
+        self.assertTrue(np.allclose(atlas_maps._maps_atlas.toarray(), maps._maps_atlas.toarray()))
+        self.assertTrue(np.allclose(atlas_maps.avg()._maps_atlas.toarray(), maps.avg()._maps_atlas.toarray()))
+        self.assertTrue(np.allclose(atlas_maps.var()._maps_atlas.toarray(), maps.var()._maps_atlas.toarray()))
+        self.assertTrue(np.allclose(atlas_maps.cov(atlas=True)[0], maps.cov(atlas=True)[0]))
+
+    def test_atlas_space_methods(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask, atlas=atlas)
+        atlas_maps = Maps(df_ex, template=template, groupby_col=groupby_col, mask=gray_mask, atlas=atlas, space='atlas')
+        self.assertTrue('N Nonzero' in str(atlas_maps))
+        self.assertTrue(np.allclose(atlas_maps.normalize()._maps_atlas.toarray(), maps.normalize()._maps_atlas.toarray()))
+
+        atlas_A, atlas_B = atlas_maps.split(prop=0.5, random_state=0)
+        maps_A, maps_B = maps.split(prop=0.5, random_state=0)
+        self.assertTrue(np.allclose(atlas_A._maps_atlas.toarray(), maps_A._maps_atlas.toarray()))
+        self.assertTrue(np.allclose(atlas_B._maps_atlas.toarray(), maps_B._maps_atlas.toarray()))
+
+        shuffled = atlas_maps.shuffle(random_state=0)
+        self.assertIsNone(shuffled._maps)
+        self.assertTrue(np.allclose(shuffled._maps_atlas.toarray(), maps.shuffle(random_state=0)._maps_atlas.toarray()))
+
+        for method in [atlas_maps.smooth, atlas_maps.iterative_smooth_avg_var, atlas_maps.threshold]:
+            with self.assertRaises(ValueError):
+                method(1.)
+
+    def test_atlas_space_no_atlas(self):
+        with self.assertRaises(TypeError):
+            Maps(df_ex, template=template, groupby_col=groupby_col, space='atlas')
+
+
+class MultiAtlasInitTestCase(unittest.TestCase):
+    def setUp(self):
+        labels = nilearn.image.load_img(atlas['maps']).get_fdata()
+        prob = np.stack([labels == 1, 0.5*(labels == 1) + (labels == 2)], axis=3).astype(np.float64)
+        self.prob = prob.reshape((-1, 2), order='F')
+        self.prob_atlas = {'maps': nib.Nifti1Image(prob, affine), 'labels': ['A', 'B']}
+
+    def test_multi_atlas(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, atlas=atlas)
+        multi = Maps(df_ex, template=template, groupby_col=groupby_col, atlas=[atlas, self.prob_atlas])
+        expected = self.prob.T.dot(multi.maps.toarray())/self.prob.sum(axis=0)[:, None]
+
+        self.assertEqual(multi._maps_atlas.shape[0], maps._atlas.n_labels+2)
+        self.assertTrue(np.allclose(multi.get_maps_atlas(0).toarray(), maps._maps_atlas.toarray()))
+        self.assertTrue(np.allclose(multi.get_maps_atlas(1).toarray(), expected))
+        self.assertTrue(np.allclose(multi.cov(atlas=True)[0], maps.cov(atlas=True)[0]))
@@ -37,6 +37,34 @@ class AtlasTestCase(unittest.TestCase):
         maps = Maps(template=template, atlas=atlas)
         self.assertTrue(maps._has_atlas())
 
+    def test_filter_matrix(self):
+        maps = Maps(template=template, atlas=atlas)
+        atlas_data = maps._flatten_array(maps._atlas.data)
+        filter_matrix = maps._atlas_filter_matrix.toarray()
+        for k in range(maps._atlas.n_labels):
+            row = atlas_data == k
+            self.assertTrue(np.allclose(filter_matrix[k, row], 1/np.sum(row)))
+            self.assertTrue(np.all(filter_matrix[k, ~row] == 0))
+
+    def test_filter_matrix_shared(self):
+        maps1 = Maps(template=template, atlas=atlas)
+        maps2 = Maps(template=template, atlas=atlas)
+        self.assertTrue(maps1._atlas_filter_matrix is maps2._atlas_filter_matrix)
+
+    def test_shared_atlas(self):
+        maps1 = Maps(template=template, atlas=atlas)
+        maps2 = Maps(template=template, atlas=atlas)
+        self.assertTrue(maps1._atlas is maps2._atlas)
+        self.assertEqual(maps1._atlas.data.dtype.kind in 'ui', True)
+        self.assertFalse(maps1._atlas.data.flags.writeable)
+
+    def test_lazy_atlas_maps(self):
+        maps = Maps(template=template, atlas=atlas)
+        maps.maps = scipy.sparse.random(maps.prod_N, 3, density=0.01, format='csr')
+        self.assertTrue(maps._atlas_maps_dirty)
+        self.assertTrue(np.allclose(maps._maps_atlas.toarray(), maps._atlas_filter_matrix.dot(maps.maps).toarray()))
+        self.assertFalse(maps._atlas_maps_dirty)
+
 class StrTestCase(unittest.TestCase):
     def test_minimal(self):
         maps = Maps(np.array([[0]]), Ni=1, Nj=1, Nk=1)
@@ -1,9 +1,10 @@
 import unittest
 import numpy as np
 import nibabel as nib
+import pandas as pd
 
 from meta_analysis import Maps
-from globals_test import affine, maps
+from globals_test import affine, maps, template, atlas, df_ex, groupby_col
 
 
 class ApplyMaskTestCase(unittest.TestCase):
@@ -94,6 +95,86 @@ class NormalizeTestCase(unittest.TestCase):
         self.assertTrue(np.array_equal(maps2_.to_array(1), self.expected2[:, :, :, 1]))
 
 
+class AppendDfTestCase(unittest.TestCase):
+    def setUp(self):
+        self.df = pd.DataFrame(np.array([['mymap', 30, -20, 10, 1], ['mymap3', -3, 42, 12, 2]]), columns=['map__id', 'x', 'y', 'z', 'weight'])
+        self.df_full = pd.concat([df_ex, self.df], ignore_index=True)
+
+    def test_append(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, atlas=atlas)
+        maps_ = maps.append_df(self.df, groupby_col=groupby_col)
+        expected = Maps(self.df_full, template=template, groupby_col=groupby_col, atlas=atlas)
+
+        self.assertEqual(maps.n_maps, 2)
+        self.assertEqual(maps_.map_ids, ['mymap', 'mymap2', 'mymap3'])
+        self.assertTrue(np.array_equal(maps_.to_array(), expected.to_array()))
+        self.assertTrue(np.allclose(maps_._maps_atlas.toarray(), expected._maps_atlas.toarray()))
+
+    def test_append_atlas_space(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, atlas=atlas, space='atlas')
+        maps_ = maps.append_df(self.df, groupby_col=groupby_col)
+        expected = Maps(self.df_full, template=template, groupby_col=groupby_col, atlas=atlas, space='atlas')
+
+        self.assertIsNone(maps_._maps)
+        self.assertEqual(maps_.map_ids, ['mymap', 'mymap2', 'mymap3'])
+        self.assertTrue(np.allclose(maps_._maps_atlas.toarray(), expected._maps_atlas.toarray()))
+
+    def test_append_inplace(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col)
+        maps.append_df(self.df, groupby_col=groupby_col, inplace=True)
+
+        self.assertEqual(maps.n_maps, 3)
+
+    def test_no_map_ids(self):
+        with self.assertRaises(ValueError):
+            Maps.zeros(template=template).append_df(self.df, groupby_col=groupby_col)
+
+
+class ReduceTestCase(unittest.TestCase):
+    def setUp(self):
+        self.array = np.arange(4*4*2, dtype=np.float64).reshape((4, 4, 2))
+        self.maps = Maps(self.array, affine=affine)
+
+    def test_reduce(self):
+        maps = self.maps.reduce(2)
+        self.assertEqual(maps.shape, (2, 2, 1, 1))
+        self.assertTrue(np.allclose(maps.affine, affine.dot(np.diag([2, 2, 2, 1]))))
+        self.assertTrue(np.allclose(maps.to_array(), self.array.reshape((2, 2, 2, 2, 1, 2)).sum(axis=(1, 3, 5))))
+        self.assertEqual(maps.sum(), self.maps.sum())
+
+    def test_odd(self):
+        maps = self.maps.reduce(3)
+        self.assertEqual(maps.shape, (2, 2, 1, 1))
+        self.assertEqual(maps.sum(), self.maps.sum())
+
+    def test_coordinates(self):
+        maps = Maps(df_ex, template=template, groupby_col=groupby_col, atlas=atlas)
+        maps_r = Maps(df_ex, template=template, groupby_col=groupby_col, atlas=atlas, reduce=2)
+        self.assertEqual(maps_r.shape, maps.reduce(2).shape)
+        self.assertTrue(np.allclose(maps_r.to_array(), maps.reduce(2).to_array()))
+
+
+class AtlasLevelTestCase(unittest.TestCase):
+    def setUp(self):
+        self.labels = np.array([0, 1, 1, 2, 2, 2, 3, 0]).reshape((2, 2, 2), order='F').astype(np.int16)
+        self.atlas = {
+            'maps': nib.Nifti1Image(self.labels, np.eye(4)),
+            'labels': ['Background', 'A', 'B', 'C'],
+            'levels': [{'labels': ['AB', 'C'], 'parents': [None, 'AB', 'AB', 'C']}]
+        }
+        self.coarse_atlas = {
+            'maps': nib.Nifti1Image(np.array([2, 0, 0, 0, 0, 0, 1, 2]).reshape((2, 2, 2), order='F').astype(np.int16), np.eye(4)),
+            'labels': ['AB', 'C']
+        }
+        self.array = np.random.rand(2, 2, 2, 3)
+
+    def test_level(self):
+        maps = Maps(self.array, affine=np.eye(4), atlas=self.atlas)
+        coarse_maps = Maps(self.array, affine=np.eye(4), atlas=self.coarse_atlas)
+        self.assertEqual(maps.get_maps_atlas(level=0).shape, (2, 3))
+        self.assertTrue(np.allclose(maps.get_maps_atlas(level=0).toarray(), coarse_maps.get_maps_atlas().toarray()))
+
+
 class RandomizeTestCase(unittest.TestCase):
     def setUp(self):
         self.p = np.array([[[0, 0.25, 0],
@@ -0,0 +1,189 @@
+"""Test the smoothing engines of meta_analysis."""
+import unittest
+import numpy as np
+import scipy.sparse
+from scipy.ndimage import gaussian_filter
+
+from meta_analysis.smoothing import gaussian_kernel1d, stamp_smooth, use_stamping, dense_smooth, smooth_block, \
+    gaussian_spectrum, use_fft, filter_block, FFT_RTOL, smoothing_operator, apply_operator, \
+    sparsify
+
+
+def filter_maps(maps, shape, sigma):
+    arrays = [maps[:, k].toarray().reshape(shape, order='F') for k in range(maps.shape[1])]
+    return np.stack([gaussian_filter(array, sigma).reshape(-1, order='F') for array in arrays], axis=1)
+
+
+class StampSmoothTestCase(unittest.TestCase):
+    """Test stamp_smooth function."""
+
+    def setUp(self):
+        self.shape = (12, 9, 7)
+        self.maps = scipy.sparse.random(np.prod(self.shape), 4, density=0.01, format='csr', random_state=0)
+
+    def test_gaussian_filter(self):
+        """Test equality with gaussian_filter, borders included."""
+        for sigma in [0.5, 1., 3.]:
+            smoothed = stamp_smooth(self.maps, self.shape, sigma)
+            self.assertTrue(np.allclose(smoothed.toarray(), filter_maps(self.maps, self.shape, sigma)))
+
+    def test_groups(self):
+        """Test that grouping the columns does not change the result."""
+        smoothed = stamp_smooth(self.maps, self.shape, 1., max_entries=1)
+        self.assertTrue(np.allclose(smoothed.toarray(), filter_maps(self.maps, self.shape, 1.)))
+
+    def test_empty_maps(self):
+        """Test that maps without nonzero voxels stay empty, alone or in groups."""
+        maps = scipy.sparse.hstack([scipy.sparse.csr_matrix(self.maps.shape), self.maps], format='csr')
+        self.assertEqual(stamp_smooth(maps[:, :2], self.shape, 1.).nnz, 0)
+        smoothed = stamp_smooth(maps, self.shape, 1.).toarray()
+        self.assertTrue(np.allclose(smoothed, filter_maps(maps, self.shape, 1.)))
+
+    def test_kernel_cache(self):
+        """Test that kernels are computed once per sigma."""
+        self.assertTrue(gaussian_kernel1d(2.) is gaussian_kernel1d(2.))
+        self.assertTrue(np.isclose(gaussian_kernel1d(2.).sum(), 1))
+
+    def test_use_stamping(self):
+        """Test that stamping is only used on few nonzero voxels."""
+        self.assertTrue(np.array_equal(use_stamping([1, 10**6], (91, 109, 91), 2.), [True, False]))
+        self.assertFalse(use_stamping(np.array([350000], dtype=np.int32), (91, 109, 91), 1.)[0])
+
+
+class DenseSmoothTestCase(unittest.TestCase):
+    """Test dense_smooth and smooth_block functions."""
+
+    def setUp(self):
+        self.shape = (12, 9, 7)
+        self.maps = scipy.sparse.random(np.prod(self.shape), 5, density=0.5, format='csr', random_state=0)
+
+    def test_blocks(self):
+        """Test equality with gaussian_filter for several block sizes and threads."""
+        expected = filter_maps(self.maps, self.shape, 1.5)
+        for max_bytes, n_jobs in [(1, 1), (8*np.prod(self.shape)*2, 2), (2**27, 3)]:
+            smoothed = dense_smooth(self.maps, self.shape, 1.5, max_bytes=max_bytes, n_jobs=n_jobs)
+            self.assertTrue(np.allclose(smoothed.toarray(), expected))
+
+    def test_smooth_block(self):
+        """Test that sparse and dense blocks give the same result in a larger buffer."""
+        buffer = np.zeros(self.shape+(8,), order='F')
+        array = self.maps.toarray().reshape(self.shape+(5,), order='F')
+        sparse_block = smooth_block(self.maps, self.shape, 1.5, buffer).copy()
+        dense_block = smooth_block(array, self.shape, 1.5, buffer)
+        self.assertTrue(np.allclose(sparse_block, dense_block))
+        self.assertTrue(np.allclose(dense_block, filter_maps(self.maps, self.shape, 1.5)))
+
+    def test_sigma_per_axis(self):
+        """Test equality with gaussian_filter with one sigma per axis, null ones included."""
+        for sigma in [(1., 2., 0.5), (0., 1.5, 0.), (0, 0, 0)]:
+            smoothed = dense_smooth(self.maps, self.shape, sigma)
+            self.assertTrue(np.allclose(smoothed.toarray(), filter_maps(self.maps, self.shape, sigma)))
+        block = self.maps.toarray().reshape(self.shape+(5,), order='F')
+        expected = filter_maps(self.maps, self.shape, (0.5, 8., 6.)).reshape(self.shape+(5,), order='F')
+        self.assertTrue(np.allclose(filter_block(block, (0.5, 8., 6.), method='fft'), expected))
+
+
+class FFTFilterTestCase(unittest.TestCase):
+    """Test filter_block function with the FFT method."""
+
+    def setUp(self):
+        self.shape = (12, 9, 7)
+        self.maps = scipy.sparse.random(np.prod(self.shape), 3, density=0.05, format='csr', random_state=0)
+        self.block = self.maps.toarray().reshape(self.shape+(3,), order='F')
+
+    def test_gaussian_filter(self):
+        """Test equality with gaussian_filter within the documented tolerance, kernels wider than the box included."""
+        for sigma in [0.5, 2., 20.]:
+            expected = filter_maps(self.maps, self.shape, sigma).reshape(self.shape+(3,), order='F')
+            smoothed = filter_block(self.block.copy(order='F'), sigma, method='fft')
+            self.assertTrue(np.all(np.abs(smoothed-expected) <= FFT_RTOL*np.abs(expected).max(axis=(0, 1, 2))))
+            self.assertTrue(np.all(smoothed[expected == 0] == 0))
+
+    def test_direct(self):
+        """Test that the direct method equals gaussian_filter."""
+        expected = filter_maps(self.maps, self.shape, 2.).reshape(self.shape+(3,), order='F')
+        self.assertTrue(np.allclose(filter_block(self.block.copy(order='F'), 2., method='direct'), expected))
+        with self.assertRaises(ValueError):
+            filter_block(self.block, 2., method='unknown')
+
+    def test_spectrum_cache(self):
+        """Test that spectra are computed once per axis size and sigma."""
+        self.assertTrue(gaussian_spectrum(12, 2.) is gaussian_spectrum(12, 2.))
+        self.assertTrue(np.isclose(gaussian_spectrum(12, 2.)[0], 1))
+
+    def test_use_fft(self):
+        """Test that FFT is only used on wide kernels and fast axis sizes."""
+        self.assertFalse(use_fft(91, 2.))
+        self.assertTrue(use_fft(91, 10.))
+        self.assertFalse(use_fft(109, 10.))
+
+
+class SmoothingOperatorTestCase(unittest.TestCase):
+    """Test smoothing_operator and apply_operator functions."""
+
+    def setUp(self):
+        self.shape = (12, 9, 7)
+        self.maps = scipy.sparse.random(np.prod(self.shape), 4, density=0.1, format='csr', random_state=0)
+
+    def test_gaussian_filter(self):
+        """Test equality with gaussian_filter, kernels wider than the box included."""
+        for sigma in [0.5, 1.5, 10., (1., 0., 2.)]:
+            operator = smoothing_operator(self.shape, sigma)
+            self.assertTrue(np.allclose(operator.dot(self.maps).toarray(), filter_maps(self.maps, self.shape, sigma)))
+
+    def test_mask(self):
+        """Test that the operator restricted to a mask drops the values smoothed out of it."""
+        inside = np.random.RandomState(0).rand(np.prod(self.shape)) > 0.4
+        maps = scipy.sparse.diags(inside.astype(float)).dot(self.maps)
+        operator = smoothing_operator(self.shape, 1.5, voxel_ids=np.flatnonzero(inside), max_entries=100)
+        expected = filter_maps(maps, self.shape, 1.5)*inside[:, None]
+        self.assertTrue(np.allclose(operator.dot(maps).toarray(), expected))
+        self.assertEqual(operator[~inside].nnz, 0)
+
+    def test_truncate(self):
+        """Test that the kernel is truncated at the given number of sigmas."""
+        operator = smoothing_operator(self.shape, 2., truncate=1.)
+        self.assertTrue(np.all(np.diff(operator.indptr) <= 5**3))
+
+    def test_apply_operator(self):
+        """Test that splitting the product among threads does not change it."""
+        operator = smoothing_operator(self.shape, 1.5)
+        expected = operator.dot(self.maps).toarray()
+        for n_jobs in [1, 2, 5]:
+            self.assertTrue(np.allclose(apply_operator(operator, self.maps, n_jobs=n_jobs).toarray(), expected))
+
+
+class SparsifyTestCase(unittest.TestCase):
+    """Test sparsify function and the tolerances of dense_smooth."""
+
+    def setUp(self):
+        self.shape = (12, 9, 7)
+        self.maps = scipy.sparse.random(np.prod(self.shape), 3, density=0.05, format='csr', random_state=0)
+
+    def test_tolerances(self):
+        """Test that only the values below max(atol, rtol*max) of each map are dropped."""
+        smoothed = filter_maps(self.maps, self.shape, 1.5)
+        maxima = np.abs(smoothed).max(axis=0)
+        for rtol, atol in [(0., 0.), (1e-2, 0.), (0., 1e-3), (1e-2, 1e-3)]:
+            sparse = sparsify(scipy.sparse.csr_matrix(smoothed), rtol=rtol, atol=atol).toarray()
+            kept = np.abs(smoothed) > np.maximum(atol, rtol*maxima)
+            self.assertTrue(np.array_equal(sparse, np.where(kept, smoothed, 0)))
+
+    def test_dense_smooth(self):
+        """Test that dense_smooth drops the same values as sparsify."""
+        expected = sparsify(scipy.sparse.csr_matrix(filter_maps(self.maps, self.shape, 1.5)), rtol=1e-2, atol=1e-4)
+        smoothed = dense_smooth(self.maps, self.shape, 1.5, rtol=1e-2, atol=1e-4)
+        self.assertEqual(smoothed.nnz, expected.nnz)
+        self.assertTrue(np.allclose(smoothed.toarray(), expected.toarray()))
+
+    def test_dense_output(self):
+        """Test that dense outputs equal the sparse ones."""
+        expected = dense_smooth(self.maps, self.shape, 1.5, rtol=1e-2, atol=1e-4)
+        for n_jobs in [1, 2]:
+            smoothed = dense_smooth(self.maps, self.shape, 1.5, n_jobs=n_jobs, rtol=1e-2, atol=1e-4, dense=True)
+            self.assertTrue(isinstance(smoothed, np.ndarray))
+            self.assertTrue(np.array_equal(smoothed, expected.toarray()))
+        operator = smoothing_operator(self.shape, 1.5)
+        smoothed = apply_operator(operator, self.maps.toarray(), n_jobs=2)
+        self.assertTrue(isinstance(smoothed, np.ndarray))
+        self.assertTrue(np.allclose(smoothed, operator.dot(self.maps).toarray()))
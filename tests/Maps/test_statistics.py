@@ -195,3 +195,13 @@ class IterativeVsManual(unittest.TestCase):
         maps2.smooth(sigma=sigma, inplace=True)
 
         self.assertTrue(np.allclose(maps2.var(bias=False).to_array(), var.to_array()))
+
+    def test_var_sigma_per_axis(self):
+        maps2 = Maps(self.array2, Ni=self.Ni, Nj=self.Nj, Nk=self.Nk)
+
+        sigma = (1., 2., 0.)
+        avg, var = maps2.iterative_smooth_avg_var(sigma=sigma, bias=False)
+        maps2.smooth(sigma=sigma, inplace=True)
+
+        self.assertTrue(np.allclose(maps2.avg().to_array(), avg.to_array()))
+        self.assertTrue(np.allclose(maps2.var(bias=False).to_array(), var.to_array()))